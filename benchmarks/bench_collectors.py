@@ -0,0 +1,224 @@
+# coding=utf-8
+
+"""
+Benchmark of the MySQL collectors against the in-process fake MySQLdb of
+fakes.py, at a configurable scale and with injected latencies.
+
+Every scenario runs in its own process, so that its peak memory usage is not
+affected by the other scenarios. For each scenario the collector is created,
+collect() is called once to warm up the caches and the counter state, then
+--cycles times. Reported per scenario:
+
+ * wall_ms: median wall time of a measured collect()
+ * peak_rss_kb: peak resident memory of the process
+ * gc_objects: net number of objects tracked by the garbage collector that
+   were allocated by a measured collect(), with the collector disabled. Python
+   2 has no allocation tracing, this counts the container objects (tuples,
+   lists, dicts, ...) that are allocated and not freed yet.
+ * metrics: number of metrics published by the last collect()
+
+Usage:
+
+    python benchmarks/bench_collectors.py                       # all scenarios
+    python benchmarks/bench_collectors.py -s perfschema_large -c 5
+    python benchmarks/bench_collectors.py --save baseline.json
+    python benchmarks/bench_collectors.py --baseline baseline.json --tolerance 0.2
+
+With --baseline, scenarios whose wall time, memory or objects exceed the
+baseline by more than the tolerance, or which publish a different number of
+metrics, are reported as regressions and the exit status is 1.
+"""
+
+import gc
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERFSCHEMA = 'perfschema'
+SIZES = 'sizes'
+
+# name: (collector, number of hosts, scale, backend options, collector options)
+SCENARIOS = {
+    'perfschema_small': (PERFSCHEMA, 1, fakes.Scale(schemas=5, tables=20, indexes=3), {}, {}),
+    'perfschema_large': (PERFSCHEMA, 1, fakes.Scale(schemas=50, tables=200, indexes=4), {}, {}),
+    'perfschema_large_streaming': (PERFSCHEMA, 1, fakes.Scale(schemas=50, tables=200, indexes=4), {},
+                                   {'streaming': True}),
+    'perfschema_large_rollup': (PERFSCHEMA, 1, fakes.Scale(schemas=50, tables=200, indexes=4), {},
+                                {'rollup': True}),
+    'perfschema_large_latency': (PERFSCHEMA, 1, fakes.Scale(schemas=50, tables=200, indexes=4), {},
+                                 {'latency': True}),
+    'perfschema_all_sources': (PERFSCHEMA, 1, fakes.Scale(schemas=10, tables=100, indexes=3), {},
+                               {'sources': ['table_io', 'index_io', 'table_lock', 'file_io',
+                                            'wait_events', 'statements']}),
+    'perfschema_hosts_latency': (PERFSCHEMA, 8, fakes.Scale(schemas=5, tables=50, indexes=3),
+                                 {'execute_latency': 0.02, 'fetch_latency': 0.001}, {'max_workers': 4}),
+    'sizes_large': (SIZES, 1, fakes.Scale(schemas=100, tables=200), {}, {'size_source': 'tables'}),
+    'sizes_large_streaming': (SIZES, 1, fakes.Scale(schemas=100, tables=200), {},
+                              {'size_source': 'tables', 'streaming': True}),
+    'sizes_innodb_stats': (SIZES, 1, fakes.Scale(schemas=100, tables=200), {}, {'size_source': 'auto'}),
+    'sizes_incremental': (SIZES, 1, fakes.Scale(schemas=100, tables=200), {}, {'incremental': True}),
+    'sizes_rollup': (SIZES, 1, fakes.Scale(schemas=100, tables=200), {}, {'rollup': True}),
+    'sizes_hosts_latency': (SIZES, 8, fakes.Scale(schemas=10, tables=100),
+                            {'execute_latency': 0.02, 'fetch_latency': 0.001}, {'max_workers': 4}),
+}
+
+# measurements compared with the baseline, relative to the tolerance
+COMPARED = ('wall_ms', 'peak_rss_kb', 'gc_objects')
+
+
+def create_collector(kind, hosts, options):
+    if kind == PERFSCHEMA:
+        sys.path.insert(0, os.path.join(ROOT, 'diamond_collectors', 'mysqlperfschema'))
+        from mysqlperfschema import MySQLPerfSchemaCollector
+        config = fakes.Config(options)
+        config['hosts'] = ['stats:secret@host%d:3306/None' % i for i in range(hosts)]
+        return MySQLPerfSchemaCollector(config=config)
+
+    sys.path.insert(0, os.path.join(ROOT, 'diamond_collectors', 'mysqlsizes'))
+    from mysqldbsizes import MySQLSizeCollector
+    config = fakes.Config(options)
+    for i in range(hosts):
+        section = 'host%d' % i
+        config[section] = {'host': section}
+        config.sections.append(section)
+    return MySQLSizeCollector(config=config)
+
+
+# Run a scenario in the current process and return its measurements
+def run_scenario(name, cycles):
+    kind, hosts, scale, backend, options = SCENARIOS[name]
+    fakes.DEFAULT[0] = fakes.Backend(scale, **backend)
+    collector = create_collector(kind, hosts, options)
+
+    # warm up
+    collector.collect()
+
+    times = []
+    objects = []
+    for i in range(cycles):
+        collector.published = 0
+        gc.collect()
+        gc.disable()
+        before = gc.get_count()[0]
+        start = time.time()
+        collector.collect()
+        times.append(time.time() - start)
+        objects.append(gc.get_count()[0] - before)
+        gc.enable()
+
+    times.sort()
+    objects.sort()
+    return {
+        'scenario': name,
+        'hosts': hosts,
+        'scale': scale.to_dict(),
+        'cycles': cycles,
+        'wall_ms': round(times[len(times) // 2] * 1000, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'gc_objects': objects[len(objects) // 2],
+        'metrics': collector.published,
+    }
+
+
+# Run a scenario in a child process and return its measurements
+def spawn_scenario(name, cycles):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name,
+                                '--cycles', str(cycles)], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError('scenario %s failed with status %d' % (name, process.returncode))
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+# Compare the results with the baseline, returns the list of regressions
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = {}
+    for result in baseline:
+        previous[result['scenario']] = result
+    for result in results:
+        old = previous.get(result['scenario'])
+        if old is None:
+            continue
+        for key in COMPARED:
+            if old[key] > 0 and result[key] > old[key] * (1 + tolerance):
+                regressions.append('%s: %s %s -> %s (+%.0f%%)' % (
+                    result['scenario'], key, old[key], result[key], (float(result[key]) / old[key] - 1) * 100))
+        if result['metrics'] != old['metrics']:
+            regressions.append('%s: metrics %d -> %d' % (result['scenario'], old['metrics'], result['metrics']))
+    return regressions
+
+
+def report(results, baseline):
+    previous = {}
+    for result in baseline or ():
+        previous[result['scenario']] = result
+    print('%-28s %10s %12s %11s %9s' % ('scenario', 'wall_ms', 'peak_rss_kb', 'gc_objects', 'metrics'))
+    for result in results:
+        print('%-28s %10.1f %12d %11d %9d' % (result['scenario'], result['wall_ms'], result['peak_rss_kb'],
+                                             result['gc_objects'], result['metrics']))
+        old = previous.get(result['scenario'])
+        if old is not None:
+            print('%-28s %10.1f %12d %11d %9d' % ('  baseline', old['wall_ms'], old['peak_rss_kb'],
+                                                 old['gc_objects'], old['metrics']))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--scenario', action='append', dest='scenarios',
+                      help='scenario to run, may be repeated (default: all): ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_option('-c', '--cycles', type='int', default=3, help='measured collections per scenario')
+    parser.add_option('--save', help='save the results as a baseline to this file')
+    parser.add_option('--baseline', help='compare the results with the baseline saved in this file')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='relative increase over the baseline reported as a regression')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    fakes.install()
+    if options.child:
+        print(json.dumps(run_scenario(options.child, options.cycles)))
+        return 0
+
+    names = options.scenarios or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: %s' % name)
+
+    baseline = None
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+    results = [spawn_scenario(name, options.cycles) for name in names]
+    report(results, baseline)
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
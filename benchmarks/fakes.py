@@ -0,0 +1,382 @@
+# coding=utf-8
+
+"""
+In-process stand-ins for MySQLdb and diamond.collector, used to benchmark the
+collectors without a MySQL server or a Diamond installation.
+
+The fake MySQLdb answers the queries of the collectors with synthetic result
+sets generated from a Scale (schemas x tables x indexes of each host). Counters
+grow at every query so that rates are not zero. Each query and each fetch can
+be delayed to simulate the network and the server.
+
+install() must be called before importing the collectors.
+"""
+
+import re
+import sys
+import time
+import types
+
+
+# Size of the synthetic data set of every host
+class Scale(object):
+
+    def __init__(self, schemas=10, tables=100, indexes=3, files=None, events=200, digests=1000):
+        self.schemas = schemas
+        self.tables = tables
+        self.indexes = indexes
+        # one tablespace per table by default
+        self.files = files
+        self.events = events
+        self.digests = digests
+
+    def table_names(self):
+        for s in range(self.schemas):
+            for t in range(self.tables):
+                yield 'schema_%d' % s, 'table_%d' % t
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+# Behaviour of the fake server: data set, version and latencies in seconds
+class Backend(object):
+
+    def __init__(self, scale, version='5.7.30-log', execute_latency=0.0, fetch_latency=0.0):
+        self.scale = scale
+        self.version = version
+        self.execute_latency = execute_latency
+        self.fetch_latency = fetch_latency
+        # number of queries answered, counters grow with it
+        self.queries = 0
+        self.started = time.time()
+        # keys of the rows of each performance schema table, generated once
+        self.keys = {}
+
+    # Return (column names, rows) of a single statement
+    def answer(self, sql, args):
+        self.queries = self.queries + 1
+        lower = sql.lower()
+        if 'uptime' in lower:
+            return ['Variable_name', 'Value'], [('Uptime', str(int(time.time() - self.started) + 1000))]
+        if 'performance_schema.' in lower:
+            return self._perfschema(lower)
+        if 'innodb_table_stats' in lower:
+            if 'group by' in lower:
+                return self._fingerprints(lower)
+            return self._innodb_stats(args)
+        if 'information_schema.files' in lower:
+            return self._files()
+        if 'information_schema.tables' in lower:
+            if 'group by' in lower:
+                return self._fingerprints(lower)
+            return self._table_sizes(args)
+        raise ProgrammingError(1064, 'unexpected query: %s' % sql)
+
+    def _columns(self, sql):
+        # the perfschema collector aliases the selected columns c0, c1, ...
+        aliases = [int(n) for n in re.findall(r' as c(\d+)', sql)]
+        return ['c%d' % i for i in range(max(aliases) + 1)]
+
+    def _perfschema(self, sql):
+        columns = self._columns(sql)
+        n = self.queries
+        keys, rows = self._keys(sql)
+        values = len(columns) - keys
+        result = []
+        for r, key in enumerate(rows):
+            # counters of different rows grow at different rates
+            result.append(key + tuple([(r % 7 + 1) * (v + 1) * n * 1000 for v in range(values)]))
+        return columns, result
+
+    # Return the number of key columns and the keys of the rows of a performance schema table
+    def _keys(self, sql):
+        for name, cached in self.keys.items():
+            if name in sql:
+                return cached
+        scale = self.scale
+        rows = []
+        if 'table_io_waits_summary_by_index_usage' in sql:
+            name = 'table_io_waits_summary_by_index_usage'
+            keys = 3
+            for schema, table in scale.table_names():
+                for i in range(scale.indexes):
+                    rows.append((schema, table, i == 0 and 'PRIMARY' or 'index_%d' % i))
+        elif 'table_io_waits_summary_by_table' in sql or 'table_lock_waits_summary_by_table' in sql:
+            name = re.search('table_(io|lock)_waits_summary_by_table', sql).group(0)
+            keys = 2
+            rows = list(scale.table_names())
+        elif 'file_summary_by_instance' in sql:
+            name = 'file_summary_by_instance'
+            keys = 1
+            files = scale.files
+            if files is None:
+                files = scale.schemas * scale.tables
+            rows = [('/var/lib/mysql/data/file_%d.ibd' % f,) for f in range(files)]
+        elif 'events_waits_summary_global_by_event_name' in sql:
+            name = 'events_waits_summary_global_by_event_name'
+            keys = 1
+            rows = [('wait/synch/mutex/innodb/event_%d' % e,) for e in range(scale.events)]
+        elif 'events_statements_summary_by_digest' in sql:
+            name = 'events_statements_summary_by_digest'
+            keys = 2
+            rows = [('schema_%d' % (d % scale.schemas), '%032x' % d) for d in range(scale.digests)]
+        else:
+            raise ProgrammingError(1146, 'unknown performance schema table: %s' % sql)
+        self.keys[name] = keys, rows
+        return keys, rows
+
+    def _selected(self, args):
+        schemas = None
+        if args:
+            schemas = set(args)
+        for schema, table in self.scale.table_names():
+            if schemas is None or schema in schemas:
+                yield schema, table
+
+    def _table_sizes(self, args):
+        n = self.queries
+        columns = ['table_schema', 'table_name', 'table_rows', 'data_length', 'index_length', 'data_free']
+        rows = []
+        for t, (schema, table) in enumerate(self._selected(args)):
+            rows.append((schema, table, t * 10 + n, (t + 1) * 16384, t * 8192, 4096))
+        return columns, rows
+
+    def _innodb_stats(self, args):
+        n = self.queries
+        columns = ['table_schema', 'table_name', 'table_rows', 'data_length', 'index_length']
+        rows = []
+        for t, (schema, table) in enumerate(self._selected(args)):
+            rows.append((schema, table, t * 10 + n, (t + 1) * 16384, t * 8192))
+        return columns, rows
+
+    # File per table tablespaces are named innodb_file_per_table_<space id> on
+    # MySQL 5.7 and <schema>/<table> on 8.0
+    def _files(self):
+        columns = ['tablespace_name', 'file_name', 'data_free']
+        rows = [('innodb_system', './ibdata1', 0)]
+        for t, (schema, table) in enumerate(self.scale.table_names()):
+            name = 'innodb_file_per_table_%d' % (t + 2)
+            if not self.version.startswith('5.'):
+                name = schema + '/' + table
+            rows.append((name, './%s/%s.ibd' % (schema, table), 4096))
+        return columns, rows
+
+    # Fingerprints of the schemas, only the columns selected by the query
+    def _fingerprints(self, sql):
+        columns = ['table_schema'] + [name for name in ('tables', 'created', 'updated') if ' as ' + name in sql]
+        rows = []
+        for s in range(self.scale.schemas):
+            # one schema out of ten changes at every run
+            updated = s % 10 == self.queries % 10 and self.queries or 0
+            values = {'tables': self.scale.tables, 'created': 0, 'updated': updated}
+            rows.append(tuple(['schema_%d' % s] + [values[name] for name in columns[1:]]))
+        return columns, rows
+
+
+class MySQLError(Exception):
+    pass
+
+
+class Error(MySQLError):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class ProgrammingError(Error):
+    pass
+
+
+class Cursor(object):
+
+    dictionaries = False
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.results = []
+        self.rows = []
+        self.columns = []
+
+    def execute(self, query, args=None):
+        if self.backend.execute_latency:
+            time.sleep(self.backend.execute_latency)
+        # the arguments of a batch are consumed in order by its statements
+        args = list(args or ())
+        self.results = []
+        for statement in query.split('; '):
+            count = statement.count('%s')
+            self.results.append(self.backend.answer(statement, args[:count]))
+            args = args[count:]
+        self.nextset()
+
+    def nextset(self):
+        if not self.results:
+            return None
+        self.columns, rows = self.results.pop(0)
+        if self.dictionaries:
+            rows = [dict(zip(self.columns, row)) for row in rows]
+        self.rows = rows
+        return 1
+
+    def _fetch(self, size):
+        if self.backend.fetch_latency:
+            time.sleep(self.backend.fetch_latency)
+        rows = tuple(self.rows[:size])
+        self.rows = self.rows[size:]
+        return rows
+
+    def fetchone(self):
+        rows = self._fetch(1)
+        if rows:
+            return rows[0]
+        return None
+
+    def fetchmany(self, size=1000):
+        return self._fetch(size)
+
+    def fetchall(self):
+        return self._fetch(len(self.rows))
+
+    def close(self):
+        self.results = []
+        self.rows = []
+
+
+class SSCursor(Cursor):
+    pass
+
+
+class DictCursor(Cursor):
+    dictionaries = True
+
+
+class Connection(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.open = True
+
+    def cursor(self, cursorclass=Cursor):
+        return cursorclass(self.backend)
+
+    def ping(self, *args):
+        if not self.open:
+            raise OperationalError(2006, 'MySQL server has gone away')
+
+    def get_server_info(self):
+        return self.backend.version
+
+    def close(self):
+        self.open = False
+
+
+# Backend of each host, the default one answers for all the other hosts
+BACKENDS = {}
+DEFAULT = [Backend(Scale())]
+CONNECTS = [0]
+
+
+def connect(**params):
+    backend = BACKENDS.get(params.get('host'), DEFAULT[0])
+    if backend.execute_latency:
+        time.sleep(backend.execute_latency)
+    CONNECTS[0] = CONNECTS[0] + 1
+    return Connection(backend)
+
+
+# diamond.collector.Collector stand-in: merges the configuration with the defaults
+# and counts the published metrics instead of sending them
+class Collector(object):
+
+    def __init__(self, config=None, handlers=[], name=None, configfile=None):
+        self.name = name or self.__class__.__name__
+        self.log = _NullLog()
+        self.published = 0
+        self.last_values = {}
+        self.config = Config(self.get_default_config())
+        if config is not None:
+            self.config.update(config)
+            self.config.sections = getattr(config, 'sections', [])
+        self.process_config()
+
+    def get_default_config_help(self):
+        return {}
+
+    def get_default_config(self):
+        return {
+            'enabled': True,
+            'path': self.name.replace('Collector', '').lower(),
+            'interval': 60,
+        }
+
+    def process_config(self):
+        pass
+
+    def publish(self, name, value, raw_value=None, precision=0, metric_type='GAUGE', instance=None):
+        self.published = self.published + 1
+
+    def derivative(self, name, new, max_value=0, time_delta=True, interval=None,
+                   allow_negative=False, instance=None):
+        old = self.last_values.get(name, new)
+        self.last_values[name] = new
+        return max(new - old, 0) / float(self.config['interval'])
+
+
+# Configuration of a collector, a dict with the sections of a ConfigObj
+class Config(dict):
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.sections = []
+
+
+class _NullLog(object):
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    debug = info = warn = warning = error = exception = _ignore
+
+
+def str_to_bool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 't', 'yes', 'y', '1')
+    return bool(value)
+
+
+# Register the stand-ins as the MySQLdb and diamond.collector modules. With
+# diamond=False only MySQLdb is replaced, e.g. to test against a real Diamond.
+def install(diamond=True):
+    mysqldb = types.ModuleType('MySQLdb')
+    for name in ('MySQLError', 'Error', 'OperationalError', 'ProgrammingError', 'connect'):
+        setattr(mysqldb, name, globals()[name])
+    cursors = types.ModuleType('MySQLdb.cursors')
+    for name in ('Cursor', 'SSCursor', 'DictCursor'):
+        setattr(cursors, name, globals()[name])
+    constants = types.ModuleType('MySQLdb.constants')
+    client = types.ModuleType('MySQLdb.constants.CLIENT')
+    client.MULTI_STATEMENTS = 1 << 16
+    constants.CLIENT = client
+    mysqldb.cursors = cursors
+    mysqldb.constants = constants
+    sys.modules.update({
+        'MySQLdb': mysqldb,
+        'MySQLdb.cursors': cursors,
+        'MySQLdb.constants': constants,
+        'MySQLdb.constants.CLIENT': client,
+    })
+    if not diamond:
+        return
+
+    package = types.ModuleType('diamond')
+    collector = types.ModuleType('diamond.collector')
+    collector.Collector = Collector
+    collector.str_to_bool = str_to_bool
+    package.collector = collector
+    sys.modules.update({
+        'diamond': package,
+        'diamond.collector': collector,
+    })
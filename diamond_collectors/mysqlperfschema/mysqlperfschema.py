@@ -1,35 +1,630 @@
 try:
     import MySQLdb
     from MySQLdb import MySQLError
+    from MySQLdb.constants import CLIENT
 except ImportError:
     MySQLdb = None
 import diamond
+from diamond.collector import str_to_bool
+import array
+import heapq
+import json
+import math
+import os
 import re
+import sys
+import threading
+import time
 
-# Collector querying the performance schema of MySQL.
-class MySQLPerfSchemaCollector(diamond.collector.Collector):
+try:
+    import mysqlsnapshot
+except ImportError:
+    # installed next to this collector, before Diamond loaded its directory
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mysqlsnapshot'))
+    import mysqlsnapshot
+from mysqlsnapshot import CircuitBreaker, Rollup, check_deadline, map_hosts
+
+
+# Last value and timestamp of every counter, used to compute rates. Values and
+# timestamps are stored in arrays indexed by a slot number instead of one object
+# per series, and series not updated for max_idle cycles are evicted. If capacity
+# is set, the least recently seen series are evicted beyond capacity. The number
+# of consecutive zero rates of each series is tracked to suppress idle series.
+class CounterStore(object):
+
+    def __init__(self, max_idle, capacity=0):
+        self.max_idle = max_idle
+        self.capacity = capacity
+        self.cycle = 0
+        self.slots = {}
+        self.values = array.array('d')
+        self.times = array.array('d')
+        self.seen = array.array('l')
+        self.zeros = array.array('l')
+        self.free = []
+        # time the loaded state was saved at
+        self.saved = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _allocate(self, name):
+        # names are shared by all the series of the same table or index
+        if isinstance(name, str):
+            name = intern(name)
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.values)
+            self.values.append(0.0)
+            self.times.append(0.0)
+            self.seen.append(0)
+            self.zeros.append(0)
+        self.times[slot] = 0.0
+        self.zeros[slot] = 0
+        self.slots[name] = slot
+        return slot
+
+    # Store the new value of a counter and return its rate per second, 0 for
+    # a new series or after a counter reset, and the number of consecutive
+    # zero rates including this one. If reset, the server was restarted and
+    # the previous value is ignored.
+    def update(self, name, value, now, reset=False):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self._allocate(name)
+            elapsed = 0
+        else:
+            elapsed = now - self.times[slot]
+        delta = self._store(slot, value, now, reset)
+        if delta is None or elapsed <= 0:
+            result = 0.0
+        else:
+            result = delta / elapsed
+        if result == 0:
+            self.zeros[slot] = self.zeros[slot] + 1
+        else:
+            self.zeros[slot] = 0
+        return result, self.zeros[slot]
+
+    # Store the new value of a counter and return its increase since the previous
+    # value, None for a new series or after a counter reset
+    def delta(self, name, value, now, reset=False):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self._allocate(name)
+        return self._store(slot, value, now, reset)
+
+    def _store(self, slot, value, now, reset):
+        # timer columns are returned as decimals
+        value = float(value)
+        if self.times[slot] == 0 or reset or value < self.values[slot]:
+            result = None
+        else:
+            result = value - self.values[slot]
+        self.values[slot] = value
+        self.times[slot] = now
+        self.seen[slot] = self.cycle
+        return result
+
+    # Start a new cycle, evicting the series not seen for more than max_idle cycles
+    # and the least recently seen series beyond capacity. Returns the number of
+    # evicted series.
+    def next_cycle(self):
+        evicted = 0
+        if self.max_idle > 0:
+            oldest = self.cycle - self.max_idle
+            for name, slot in self.slots.items():
+                if self.seen[slot] < oldest:
+                    self._evict(name, slot)
+                    evicted = evicted + 1
+        excess = len(self.slots) - self.capacity
+        if self.capacity > 0 and excess > 0:
+            seen = self.seen
+            lru = sorted(self.slots.items(), key=lambda item: seen[item[1]])
+            for name, slot in lru[:excess]:
+                self._evict(name, slot)
+            evicted = evicted + excess
+        self.cycle = self.cycle + 1
+        return evicted
+
+    def _evict(self, name, slot):
+        del self.slots[name]
+        self.free.append(slot)
+
+    # Atomically write the state to path. Names are the bytes returned by the server,
+    # in whatever charset: they are written as latin-1, which maps every byte to a
+    # code point and back.
+    def save(self, path, now):
+        series = []
+        for name, slot in self.slots.iteritems():
+            series.append((name, self.values[slot], self.times[slot]))
+        tmp = path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump({'saved': now, 'series': series}, f, encoding='latin-1')
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    # Load the state saved by save(), unless older than max_age seconds.
+    # Returns the number of loaded series.
+    def load(self, path, now, max_age):
+        f = open(path)
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        if now - state['saved'] > max_age:
+            return 0
+        self.saved = state['saved']
+        for name, value, timestamp in state['series']:
+            slot = self._allocate(name.encode('latin-1'))
+            self.values[slot] = value
+            self.times[slot] = timestamp
+            self.seen[slot] = self.cycle
+        return len(state['series'])
+
+
+# Fixed size ring of the last `capacity` samples of a set of counters. The values
+# of each series are stored in a flat array, `capacity` positions per series, the
+# sample times and sequence numbers in arrays shared by all the series. A value is
+# only valid if it was stored by the sample currently at its position, so series
+# missing from a sample need not be cleared. At most max_series series are tracked.
+class SampleRing(object):
+
+    def __init__(self, capacity, max_series):
+        self.capacity = max(capacity, 2)
+        self.max_series = max_series
+        self.slots = {}
+        self.free = []
+        self.values = array.array('d')
+        self.stamps = array.array('l')
+        self.times = array.array('d', [0.0] * self.capacity)
+        self.sequences = array.array('l', [-1] * self.capacity)
+        self.sequence = -1
+        self.position = -1
+        # samples in the ring
+        self.count = 0
+        # series not tracked because of max_series
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    # Start a new sample, overwriting the oldest one if the ring is full
+    def next_sample(self, now):
+        self.sequence = self.sequence + 1
+        self.position = (self.position + 1) % self.capacity
+        self.times[self.position] = now
+        self.sequences[self.position] = self.sequence
+        self.count = min(self.count + 1, self.capacity)
+
+    # Store the value of a series in the current sample
+    def record(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            elif len(self.slots) < self.max_series:
+                slot = len(self.slots)
+                self.values.extend([0.0] * self.capacity)
+                self.stamps.extend([-1] * self.capacity)
+            else:
+                self.dropped = self.dropped + 1
+                return
+            self.slots[key] = slot
+        index = slot * self.capacity + self.position
+        self.values[index] = float(value)
+        self.stamps[index] = self.sequence
+
+    # Return {key: rates per second between consecutive samples}, then keep only
+    # the last sample, the start of the next interval. A decreasing counter was
+    # reset and gives no rate. Series missing from every sample are evicted.
+    def drain(self):
+        capacity = self.capacity
+        positions = [(self.position - i) % capacity for i in range(self.count - 1, -1, -1)]
+        rates = {}
+        for key, slot in self.slots.items():
+            base = slot * capacity
+            series = []
+            previous = None
+            for position in positions:
+                index = base + position
+                if self.stamps[index] != self.sequences[position]:
+                    previous = None
+                    continue
+                if previous is not None:
+                    elapsed = self.times[position] - self.times[previous[0]]
+                    delta = self.values[index] - previous[1]
+                    if elapsed > 0 and delta >= 0:
+                        series.append(delta / elapsed)
+                previous = (position, self.values[index])
+            if previous is None:
+                del self.slots[key]
+                self.free.append(slot)
+            elif series:
+                rates[key] = series
+        self.count = min(self.count, 1)
+        return rates
+
+
+# Background thread sampling the activity counters of the table and index sources of
+# a host every `interval` seconds into a SampleRing per source, over its own
+# connection. The interval is stretched so that the sampling queries keep the
+# connection busy at most max_duty of the time, and failures back off up to
+# max_backoff seconds.
+class BurstSampler(threading.Thread):
+
+    def __init__(self, name, params, sources, query, interval, max_duty, capacity, max_series, max_backoff):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.params = params
+        self.sources = sources
+        self.query = query
+        self.interval = interval
+        self.max_duty = max_duty
+        self.breaker = CircuitBreaker(1, interval, max_backoff)
+        self.rings = {}
+        for source in sources:
+            self.rings[source.name] = SampleRing(capacity, max_series)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.effective_interval = interval
+        self.stats = {}
+        self.error = None
+
+    def run(self):
+        conn = None
+        while not self.stopping.isSet():
+            start = time.time()
+            if self.breaker.allow(start):
+                try:
+                    if conn is None:
+                        conn = MySQLdb.connect(**self.params)
+                    self._sample(conn)
+                    self.breaker.success()
+                except MySQLError, e:
+                    self.error = e
+                    self._add_stat('errors', 1)
+                    self.breaker.failure(time.time())
+                    if conn is not None:
+                        try:
+                            conn.close()
+                        except MySQLError:
+                            pass
+                        conn = None
+            duration = time.time() - start
+            self.effective_interval = max(self.interval, duration / self.max_duty)
+            self.stopping.wait(max(self.effective_interval - duration, 0))
+        if conn is not None:
+            try:
+                conn.close()
+            except MySQLError:
+                pass
 
-    # Query executed when a database is specified, e.g., hosts = root:@localhost:3306/my_db
-    _TABLE_STATS = "select object_schema, object_name, count_insert, count_update, count_delete, count_read, count_write, count_star from performance_schema.table_io_waits_summary_by_table where object_schema='{0}'"
+    def _sample(self, conn):
+        start = time.time()
+        cursor = conn.cursor(cursorclass=MySQLdb.cursors.Cursor)
+        try:
+            cursor.execute(*self.query)
+            results = []
+            for i, source in enumerate(self.sources):
+                if i > 0:
+                    cursor.nextset()
+                results.append((source, cursor.fetchall()))
+        finally:
+            cursor.close()
+        now = time.time()
+        with self.lock:
+            for source, rows in results:
+                ring = self.rings[source.name]
+                ring.next_sample(now)
+                keys = len(source.keys)
+                for r in rows:
+                    if r[keys] is not None:
+                        ring.record(r[:keys], r[keys])
+            self._add_stat('samples', 1)
+            self._add_stat('sample_ms', (now - start) * 1000)
+
+    def _add_stat(self, name, value):
+        self.stats[name] = self.stats.get(name, 0) + value
+
+    # Return ({source name: {key: rates}}, statistics) of the samples since the
+    # previous call
+    def drain(self):
+        with self.lock:
+            rates = {}
+            dropped = 0
+            for name, ring in self.rings.items():
+                rates[name] = ring.drain()
+                dropped = dropped + ring.dropped
+                ring.dropped = 0
+            stats = self.stats
+            self.stats = {}
+        if stats.get('samples'):
+            stats['sample_ms'] = stats['sample_ms'] / stats['samples']
+        stats['interval'] = self.effective_interval
+        stats['series_dropped'] = dropped
+        return rates, stats
+
+    def stop(self):
+        self.stopping.set()
+
+
+# Declarative description of a performance schema query and of the metrics published
+# from its rows. Each row holds the key columns followed by the value columns, and the
+# name of each metric is template.format(*keys, metric=name of the value column).
+#  - counter: publish the rate of the values instead of the values
+#  - conditions: fixed filters of the query
+#  - group: aggregate the rows with the same keys, the values must be aggregates
+#  - schema: the first key is a schema, subject to schema_include and schema_exclude
+#  - activity: column used by min_count_star and to rank the rows
+#  - top: option holding the number of most active rows kept for each schema
+#  - sanitize: replace the characters of the keys that are not valid in a metric path
+#  - latencies: (sum_timer column, count column, metric) triples, published as the mean
+#    latency in milliseconds over the last interval, i.e., delta(sum) / delta(count)
+#  - slowest: option holding the number of rows with the highest latency published
+#    every interval, with the metric slowest.<first latency metric>
+#  - ranked: option holding K, only the top K rows by the rate of each metric of rank
+#    are published. The first value must be the number of events and the second
+#    their time in milliseconds, the mean latency is published as latency_ms.
+class Source(object):
+
+    def __init__(self, name, table, keys, values, template, counter=True, conditions=(),
+                 group=False, schema=False, activity=None, top=None, sanitize=False,
+                 latencies=(), slowest=None, ranked=None, rank=()):
+        self.name = name
+        self.table = table
+        self.keys = keys
+        self.columns = tuple([column for column, metric in values])
+        self.metrics = tuple([metric for column, metric in values])
+        self.template = template
+        self.counter = counter
+        self.conditions = conditions
+        self.group = group
+        self.schema = schema
+        self.activity = activity
+        self.top = top
+        self.sanitize = sanitize
+        self.latencies = tuple([metric for total, count, metric in latencies])
+        for total, count, metric in latencies:
+            self.columns = self.columns + (total, count)
+        self.slowest = slowest
+        self.ranked = ranked
+        self.rank = tuple([list(self.metrics).index(metric) for metric in rank])
+
+    # Metric names of the values and of the latencies of a row with the given keys
+    def metric_names(self, keys):
+        return tuple([self.metric_name(keys, metric) for metric in self.metrics + self.latencies])
 
-    # Query executed when no database is specified, e.g., hosts = root:@localhost:3306/None
-    _STATS_ALL_DATABASES = 'select object_schema, object_name, count_insert, count_update, count_delete, count_read, count_write, count_star from performance_schema.table_io_waits_summary_by_table;'
+    def metric_name(self, keys, metric):
+        if self.sanitize:
+            keys = [re.sub('[^\\w\\-]', '_', str(key)) for key in keys]
+        return self.template.format(*keys, **{'metric': metric})
 
-    # Query executed when a database is specified, e.g., hosts = root:@localhost:3306/my_db
-    _INDEX_STATS = "select object_schema, object_name, index_name, count_star, count_read, count_write, avg_timer_wait / pow(10, 9) as 'avg_timer_wait_ms', avg_timer_read / pow(10, 9) as 'avg_timer_read_ms', avg_timer_write / pow(10, 9) as 'avg_timer_write_ms' from performance_schema.table_io_waits_summary_by_index_usage where object_schema='{0}'"
 
-    # Query executed when no database is specified, e.g., hosts = root:@localhost:3306/None
-    _INDEX_ALL_DATABASES = 'select object_schema, object_name, index_name, count_star, count_read, count_write, avg_timer_wait / pow(10, 9) as "avg_timer_wait_ms", avg_timer_read / pow(10, 9) as "avg_timer_read_ms", avg_timer_write / pow(10, 9) as "avg_timer_write_ms" from performance_schema.table_io_waits_summary_by_index_usage'
+# Collector querying the performance schema of MySQL.
+class MySQLPerfSchemaCollector(diamond.collector.Collector):
 
+    # Performance schema sources, enabled with the `sources` option
+    _SOURCES = (
+        Source('table_io', 'performance_schema.table_io_waits_summary_by_table',
+               ('object_schema', 'object_name'),
+               (('count_insert', 'inserts'), ('count_update', 'updates'), ('count_delete', 'deletes'),
+                ('count_read', 'reads'), ('count_write', 'writes'), ('count_star', 'total')),
+               'table.{metric}.{0}.{1}', schema=True, activity='count_star', top='top_tables',
+               latencies=(('sum_timer_wait', 'count_star', 'latency_ms'),
+                          ('sum_timer_read', 'count_read', 'read_latency_ms'),
+                          ('sum_timer_write', 'count_write', 'write_latency_ms'))),
+        Source('index_io', 'performance_schema.table_io_waits_summary_by_index_usage',
+               ('object_schema', 'object_name', 'index_name'),
+               (('count_star', 'total'), ('count_read', 'reads'), ('count_write', 'writes')),
+               'index.{metric}.{0}.{1}.{2}', conditions=("object_schema <> 'performance_schema'",),
+               schema=True, activity='count_star', top='top_indexes',
+               latencies=(('sum_timer_wait', 'count_star', 'latency_ms'),
+                          ('sum_timer_read', 'count_read', 'read_latency_ms'),
+                          ('sum_timer_write', 'count_write', 'write_latency_ms')),
+               slowest='slowest_indexes'),
+        Source('table_lock', 'performance_schema.table_lock_waits_summary_by_table',
+               ('object_schema', 'object_name'),
+               (('count_star', 'total'), ('count_read', 'reads'), ('count_write', 'writes'),
+                ('sum_timer_wait / pow(10, 9)', 'wait_ms')),
+               'lock.{metric}.{0}.{1}', schema=True, activity='count_star', top='top_tables'),
+        Source('file_io', 'performance_schema.file_summary_by_instance',
+               ('file_name',),
+               (('sum(count_read)', 'reads'), ('sum(count_write)', 'writes'), ('sum(count_misc)', 'misc'),
+                ('sum(sum_number_of_bytes_read)', 'bytes_read'), ('sum(sum_number_of_bytes_write)', 'bytes_written'),
+                ('sum(sum_timer_wait) / pow(10, 9)', 'wait_ms')),
+               'file.{metric}.{0}', group=True, sanitize=True),
+        Source('wait_events', 'performance_schema.events_waits_summary_global_by_event_name',
+               ('event_name',),
+               (('count_star', 'total'), ('sum_timer_wait / pow(10, 9)', 'wait_ms')),
+               'wait.{metric}.{0}', conditions=('count_star > 0',), sanitize=True),
+        Source('statements', 'performance_schema.events_statements_summary_by_digest',
+               ('schema_name', 'digest'),
+               (('count_star', 'calls'), ('sum_timer_wait / pow(10, 9)', 'time_ms'),
+                ('sum_rows_examined', 'rows_examined'), ('sum_rows_sent', 'rows_sent')),
+               'statement.{metric}.{0}.{1}', schema=True, activity='count_star',
+               ranked='top_statements', rank=('time_ms', 'rows_examined')),
+    )
+
+    # Connection string format: user:passwd@host:port/db
+    _HOST_REGEX = re.compile('^([^:]*):([^@]*)@([^:]*):?([^/]*)/([^/]*)/?(.*)')
 
     def __init__(self, *args, **kwargs):
+        # process_config() is invoked by the parent constructor, so the
+        # snapshot of each host, holding its connection, has to exist before calling it
+        self.snapshots = {}
+        self.breakers = {}
+        self.host_params = []
+        self.sources = []
+        # (server version, batched query) of each host
+        self.queries = {}
+        # metric names of the keys of each source, reused across cycles
+        self.metric_names = {}
+        # (uptime, time) of the last sample of each host, to detect restarts
+        self.uptimes = {}
+        self.counters = None
+        # previous values of the ranked sources, bounded and kept apart from the counters
+        self.digests = None
+        self.now = time.time()
+        self.suppressed = 0
+        self.connects = 0
+        self.reuses = 0
+        self.lock = threading.Lock()
+        # self instrumentation of each host for the current cycle, {host: {stat: value}}
+        self.host_stats = {}
+        # BurstSampler of each host, started by the first collection
+        self.samplers = {}
+        self.burst_sources = []
+        # process that collects, the shutdown hook is registered by its first collection
+        self.pid = None
         super(MySQLPerfSchemaCollector, self).__init__(*args, **kwargs)
-        self.db = None
+
+    def get_default_config_help(self):
+        config_help = super(MySQLPerfSchemaCollector, self).get_default_config_help()
+        config_help.update({
+            'hosts': 'List of connection strings, e.g., user:passwd@host:port/db. ' +
+            'Use db "None" to collect data about all schemas.',
+            'max_workers': 'Maximum number of hosts queried concurrently. ' +
+            'Set to 1 by default, i.e., hosts are queried one after another.',
+            'connect_timeout': 'Seconds to wait for a connection to be established.',
+            'read_timeout': 'Seconds to wait for the result of a query.',
+            'write_timeout': 'Seconds to wait for a query to be sent to the server.',
+            'host_timeout': 'Total time budget in seconds for collecting from a ' +
+            'single host in one cycle, 0 to disable. The connection timeout is ' +
+            'capped to this value, the read and write timeouts to a third of it.',
+            'breaker_threshold': 'Number of consecutive failures after which a ' +
+            'host is skipped.',
+            'breaker_backoff': 'Seconds a failing host is initially skipped for. ' +
+            'The backoff doubles at every further failure.',
+            'breaker_max_backoff': 'Maximum number of seconds a failing host is skipped for.',
+            'streaming': 'Read the rows with a server side cursor and publish them ' +
+            'while iterating, instead of buffering the whole result set. Hosts are ' +
+            'then queried one after another and max_workers is ignored.',
+            'fetch_size': 'Number of rows fetched at a time in streaming mode.',
+            'counter_store': 'Keep the last value of the counters in a compact store ' +
+            'instead of the Diamond derivative state, evicting dropped tables and indexes.',
+            'counter_max_idle_cycles': 'Drop the state of the counters not seen for ' +
+            'this number of collections, 0 to never drop it.',
+            'counter_state_file': 'File where the counter state is saved on shutdown ' +
+            'and loaded from on startup. Empty to disable.',
+            'counter_state_max_age': 'Ignore a saved counter state older than this ' +
+            'number of seconds.',
+            'counter_state_save_cycles': 'Also save the counter state every this ' +
+            'number of collections, 0 to save it only on shutdown.',
+            'suppress_zero_cycles': 'Stop publishing a series after its rate has been ' +
+            'zero for this number of collections, 0 to always publish. Requires counter_store.',
+            'self_metrics': 'Publish the connect, query and fetch times, the number of ' +
+            'rows, metrics and errors of each host and the duration of the collection.',
+            'self_metrics_path': 'Path prefix of the self instrumentation metrics.',
+            'zero_heartbeat_cycles': 'Publish a suppressed series once every this ' +
+            'number of collections.',
+            'schema_include': 'List of schemas to collect, empty for all schemas.',
+            'schema_exclude': 'List of schemas not to collect.',
+            'min_count_star': 'Only collect tables and indexes with at least this ' +
+            'number of events (count_star).',
+            'top_tables': 'Only collect the N most active tables (by count_star) ' +
+            'of each schema, 0 for all tables.',
+            'top_indexes': 'Only collect the N most active indexes (by count_star) ' +
+            'of each schema, 0 for all indexes.',
+            'sources': 'List of performance schema sources to collect: table_io, ' +
+            'index_io, table_lock, file_io, wait_events, statements. All of them are ' +
+            'read in a single round trip.',
+            'top_statements': 'Number of statement digests published by time and by ' +
+            'rows examined over the last interval',
+            'statement_max_entries': 'Maximum number of statement digests tracked, the ' +
+            'least recently seen are evicted',
+            'rollup': 'Publish the rates of the tables and indexes rolled up per schema ' +
+            '(<schema>._total) and per host (_total._total), the rollup_top most active ' +
+            'rows of each source and the sum of all the other rows (_other._other), ' +
+            'instead of one series per table and index. Requires counter_store.',
+            'rollup_top': 'Number of the most active tables or indexes of each source ' +
+            'published individually in rollup mode.',
+            'latency': 'Publish the mean latency of tables and indexes over the last ' +
+            'interval, three more series per table and index. Requires counter_store.',
+            'slowest_indexes': 'Number of indexes with the highest latency over the last ' +
+            'interval published as index.slowest.latency_ms.<schema>.<table>.<index>, 0 to disable. ' +
+            'Requires latency.',
+            'burst_sampling': 'Sample the activity (count_star) of the tables and indexes every ' +
+            'burst_interval seconds in the background, and publish the peak, median, 95th and ' +
+            '99th percentile of the rates within each interval as <metric>_peak, <metric>_p50, ' +
+            '<metric>_p95 and <metric>_p99, e.g., table.total_p99.<schema>.<table>.',
+            'burst_interval': 'Seconds between two samples in burst sampling mode.',
+            'burst_sources': 'List of sources sampled in burst sampling mode, among the enabled ' +
+            'table_io, index_io and table_lock sources.',
+            'burst_max_duty': 'Maximum fraction of the time the sampling queries keep the ' +
+            'sampling connection of a host busy. The sampling interval is stretched beyond ' +
+            'burst_interval to stay below it.',
+            'burst_top': 'Number of rows of each source with the highest peak rate published in ' +
+            'burst sampling mode, 0 for all rows.',
+            'burst_max_series': 'Maximum number of tables or indexes of each source tracked in ' +
+            'burst sampling mode.',
+        })
+        return config_help
+
+    def get_default_config(self):
+        config = super(MySQLPerfSchemaCollector, self).get_default_config()
+        config.update({
+            'hosts': [],
+            'max_workers': 1,
+            'connect_timeout': 10,
+            'read_timeout': 30,
+            'write_timeout': 30,
+            'host_timeout': 45,
+            'breaker_threshold': 3,
+            'breaker_backoff': 60,
+            'breaker_max_backoff': 3600,
+            'streaming': False,
+            'fetch_size': 1000,
+            'counter_store': True,
+            'counter_max_idle_cycles': 10,
+            'counter_state_file': '',
+            'counter_state_max_age': 3600,
+            'counter_state_save_cycles': 10,
+            'suppress_zero_cycles': 0,
+            'zero_heartbeat_cycles': 10,
+            'self_metrics': True,
+            'self_metrics_path': 'collector',
+            'schema_include': [],
+            'schema_exclude': [],
+            'min_count_star': 0,
+            'top_tables': 0,
+            'top_indexes': 0,
+            'sources': ['table_io', 'index_io'],
+            'top_statements': 20,
+            'statement_max_entries': 10000,
+            'rollup': False,
+            'rollup_top': 100,
+            'latency': False,
+            'slowest_indexes': 10,
+            'burst_sampling': False,
+            'burst_interval': 5,
+            'burst_sources': ['table_io', 'index_io'],
+            'burst_max_duty': 0.05,
+            'burst_top': 100,
+            'burst_max_series': 20000,
+        })
+        return config
 
     # Load configuration
     def process_config(self):
-        if self.config['hosts'].__class__.__name__ != 'list':
-            self.config['hosts'] = [self.config['hosts']]
+        for key in ('hosts', 'schema_include', 'schema_exclude', 'sources', 'burst_sources'):
+            if self.config[key].__class__.__name__ != 'list':
+                self.config[key] = [self.config[key]]
+        for key in ('schema_include', 'schema_exclude'):
+            self.config[key] = [schema for schema in self.config[key] if schema]
+
+        sources = {}
+        for source in self._SOURCES:
+            sources[source.name] = source
+        self.sources = []
+        for name in self.config['sources']:
+            if name not in sources:
+                self.log.error('Unknown performance schema source, skipping: %s', name)
+                continue
+            self.sources.append(sources[name])
 
         # Move legacy config format to new format
         if 'host' in self.config:
@@ -42,95 +637,705 @@ class MySQLPerfSchemaCollector(diamond.collector.Collector):
             )
             self.config['hosts'].append(hoststr)
 
-        self.db = None
+        # Parse the connection strings once, not at every collection
+        self.host_params = []
+        for host in self.config['hosts']:
+            parsed = self._parse_host(host)
+            if parsed is None:
+                self.log.error('Connection string not in required format, skipping: %s', host)
+                continue
+            self.host_params.append(parsed)
+
+        # Close the connections to hosts that are no longer configured
+        configured = set([parsed[0] for parsed in self.host_params])
+        for host in list(self.snapshots.keys()):
+            if host not in configured:
+                self.snapshots.pop(host).reset()
+
+        # Keep the state of the known hosts across configuration reloads
+        breakers = {}
+        for host in configured:
+            breakers[host] = self.breakers.get(host) or CircuitBreaker(
+                int(self.config['breaker_threshold']),
+                float(self.config['breaker_backoff']),
+                float(self.config['breaker_max_backoff']))
+        self.breakers = breakers
+        # the filters may have changed
+        self.queries = {}
+
+        if not str_to_bool(self.config['counter_store']):
+            self.counters = None
+        elif self.counters is None:
+            self.counters = CounterStore(int(self.config['counter_max_idle_cycles']))
+            self.load_counter_state()
+        else:
+            self.counters.max_idle = int(self.config['counter_max_idle_cycles'])
+
+        self.suppress_zero_cycles = int(self.config['suppress_zero_cycles'])
+        self.zero_heartbeat_cycles = max(int(self.config['zero_heartbeat_cycles']), 1)
+        if self.suppress_zero_cycles > 0 and self.counters is None:
+            self.log.warn('MySQLPerfSchemaCollector: suppress_zero_cycles requires counter_store, ignoring it')
+        self.latency = str_to_bool(self.config['latency']) and self.counters is not None
+        self.rollup = str_to_bool(self.config['rollup'])
+        if self.rollup and self.counters is None:
+            self.log.warn('MySQLPerfSchemaCollector: rollup requires counter_store, ignoring it')
+            self.rollup = False
+
+        # one series per value of each digest
+        width = max([len(source.metrics) for source in self._SOURCES if source.ranked])
+        capacity = int(self.config['statement_max_entries']) * width
+        if self.digests is None:
+            self.digests = CounterStore(int(self.config['counter_max_idle_cycles']), capacity)
+        else:
+            self.digests.max_idle = int(self.config['counter_max_idle_cycles'])
+            self.digests.capacity = capacity
+
+        # the samplers are restarted by the next collection with the new configuration
+        self.stop_samplers()
+        self.burst_sources = []
+        if str_to_bool(self.config['burst_sampling']):
+            for source in self.sources:
+                if source.name not in self.config['burst_sources']:
+                    continue
+                if source.ranked or not source.schema or not source.activity:
+                    self.log.error('Source not supported by burst sampling, skipping: %s', source.name)
+                    continue
+                self.burst_sources.append(source)
 
-    # Connect to the database
-    def connect(self, params):
+    # Start the burst samplers of the hosts that have none or whose sampler died.
+    # Called by collect(), so that the threads run in the process of the collector.
+    def start_samplers(self):
+        if not self.burst_sources:
+            return
+        interval = float(self.config['burst_interval'])
+        # samples of an interval, plus the previous one and one late collection
+        capacity = int(math.ceil(float(self.config['interval']) / interval)) + 2
+        for host, params in self.host_params:
+            sampler = self.samplers.get(host)
+            if sampler is not None and sampler.isAlive():
+                continue
+            statements = []
+            args = []
+            for source in self.burst_sources:
+                # only the keys and the activity of the rows
+                activity = source.metrics[list(source.columns).index(source.activity)]
+                sampled = Source(source.name, source.table, source.keys, ((source.activity, activity),),
+                                 source.template, conditions=source.conditions, schema=source.schema,
+                                 activity=source.activity)
+                sql, source_args = self._build_query(sampled, params.get('db'), False)
+                statements.append(sql)
+                args.extend(source_args)
+            sampler = BurstSampler('%s-burst-%s' % (self.name, self._host_name(params)), dict(params),
+                                   self.burst_sources, ('; '.join(statements), tuple(args)), interval,
+                                   float(self.config['burst_max_duty']), capacity,
+                                   int(self.config['burst_max_series']), float(self.config['interval']))
+            sampler.start()
+            self.samplers[host] = sampler
+
+    # Stop the samplers, close the connections and save the counter state, once,
+    # in the process that collected
+    def shutdown(self):
+        if self.pid != os.getpid():
+            return
+        self.pid = None
+        self.stop_samplers()
+        self.close_connections()
+        self.save_counter_state()
+
+    # Stop the burst samplers, called on shutdown and when the configuration changes
+    def stop_samplers(self):
+        for sampler in self.samplers.values():
+            sampler.stop()
+        self.samplers = {}
+
+    # Load the counter state saved by a previous run, so that rates are
+    # published from the first collection after a restart
+    def load_counter_state(self):
+        path = self.config['counter_state_file']
+        if not path or not os.path.exists(path):
+            return
         try:
-            self.db = MySQLdb.connect(**params)
-            self.log.debug('MySQLPerfSchemaCollector: Connected to database.')
+            loaded = self.counters.load(path, time.time(), float(self.config['counter_state_max_age']))
+            self.log.info('MySQLPerfSchemaCollector: loaded the state of %d counters from %s', loaded, path)
+        except (IOError, OSError, ValueError, KeyError, TypeError), e:
+            self.log.error('MySQLPerfSchemaCollector could not load counter state from %s: %s', path, e)
+
+    # Save the counter state, called on shutdown and every counter_state_save_cycles.
+    # A store that never collected holds at most the loaded state, it would only
+    # replace a good state with an empty one.
+    def save_counter_state(self):
+        path = self.config['counter_state_file']
+        if self.counters is None or not path or self.counters.cycle == 0:
+            return
+        try:
+            self.counters.save(path, time.time())
+            self.log.debug('MySQLPerfSchemaCollector: saved the state of %d counters to %s', len(self.counters), path)
+        except (IOError, OSError, ValueError), e:
+            self.log.error('MySQLPerfSchemaCollector could not save counter state to %s: %s', path, e)
+
+    # Parse a connection string into (host, connection parameters)
+    def _parse_host(self, host):
+        matches = self._HOST_REGEX.search(host)
+        if not matches:
+            return None
+
+        params = {}
+
+        params['host'] = matches.group(3)
+        try:
+            params['port'] = int(matches.group(4))
+        except ValueError:
+            params['port'] = 3306
+        params['db'] = matches.group(5)
+        params['user'] = matches.group(1)
+        params['passwd'] = matches.group(2)
+
+        params['connect_timeout'] = int(self.config['connect_timeout'])
+        params['read_timeout'] = int(self.config['read_timeout'])
+        params['write_timeout'] = int(self.config['write_timeout'])
+        # never wait longer than the host time budget. libmysqlclient retries reads
+        # and writes twice, so they can take three times their timeout.
+        host_timeout = int(self.config['host_timeout'])
+        if host_timeout > 0:
+            params['connect_timeout'] = min(params['connect_timeout'], host_timeout)
+            for key in ('read_timeout', 'write_timeout'):
+                params[key] = min(params[key], max(host_timeout // 3, 1))
+        params['connect_timeout'] = max(params['connect_timeout'], 1)
+        # the queries of all the sources are sent in a single round trip
+        params['client_flag'] = CLIENT.MULTI_STATEMENTS
+
+        # If no database is selected, get data about all databases
+        if params['db'] == 'None':
+            del params['db']
+
+        return host, params
+
+    # Build the (sql, args) query of a source, with the schema and activity filters
+    # evaluated by the server. Values are always passed as arguments, never
+    # interpolated into the SQL. The top rows are ranked with row_number() if the
+    # server supports window functions.
+    def _build_query(self, source, db, window_functions):
+        conditions = list(source.conditions)
+        args = []
+        if source.schema:
+            schema = source.keys[0]
+            if db is not None:
+                conditions.append(schema + ' = %s')
+                args.append(db)
+            for key, operator in (('schema_include', 'in'), ('schema_exclude', 'not in')):
+                schemas = self.config[key]
+                if schemas:
+                    conditions.append('%s %s (%s)' % (schema, operator, ', '.join(['%s'] * len(schemas))))
+                    args.extend(schemas)
+        if source.activity and int(self.config['min_count_star']) > 0:
+            conditions.append(source.activity + ' >= %s')
+            args.append(int(self.config['min_count_star']))
+
+        # columns are aliased so that they can be selected by the ranking queries
+        expressions = source.keys + source.columns
+        names = ', '.join(['c%d' % i for i in range(len(expressions))])
+        columns = ', '.join(['%s as c%d' % (expression, i) for i, expression in enumerate(expressions)])
+        where = ''
+        if conditions:
+            where = ' where ' + ' and '.join(conditions)
+        group = ''
+        if source.group:
+            group = ' group by ' + ', '.join(source.keys)
+        sql = 'select ' + columns + ' from ' + source.table + where + group
+
+        top = 0
+        if source.top:
+            top = int(self.config[source.top])
+        if top <= 0:
+            return sql, args
+
+        # keep the `top` most active rows of each schema
+        if window_functions:
+            sql = ('select ' + names + ' from (select ' + columns +
+                   ', row_number() over (partition by ' + source.keys[0] + ' order by ' + source.activity +
+                   ' desc) as activity_rank from ' + source.table + where + ') ranked where activity_rank <= %s')
+        else:
+            # no window functions, number the rows with user variables. The limit
+            # prevents the ordered derived table from being merged into the outer query.
+            sql = ('select ' + names + ' from (select ' + names +
+                   ', @activity_rank := if(@activity_schema = c0, @activity_rank + 1, 1) as activity_rank' +
+                   ', @activity_schema := c0 as activity_schema' +
+                   ' from (' + sql + ' order by ' + source.keys[0] + ', ' + source.activity +
+                   ' desc limit 18446744073709551615) filtered' +
+                   ', (select @activity_rank := 0, @activity_schema := null) init) ranked where activity_rank <= %s')
+        args.append(top)
+        return sql, args
+
+    # Return the (sql, args) query of all the enabled sources, executed in a single
+    # round trip and built for the version of the server
+    def _get_query(self, host, params, snapshot):
+        server_info = snapshot.server_info
+        cached = self.queries.get(host)
+        if cached is not None and cached[0] == server_info:
+            return cached[1]
+
+        window_functions = self._window_functions(server_info)
+        # the uptime of the server comes first, to detect restarts. SHOW works on
+        # every version, MariaDB has no performance_schema.global_status.
+        statements = ["show global status like 'Uptime'"]
+        args = []
+        for source in self.sources:
+            sql, source_args = self._build_query(source, params.get('db'), window_functions)
+            statements.append(sql)
+            args.extend(source_args)
+        query = ('; '.join(statements), tuple(args))
+        self.queries[host] = (server_info, query)
+        return query
+
+    # Return True if the server supports window functions: MySQL 8.0+, MariaDB 10.2+.
+    # MariaDB may report its version behind a 5.5.5- prefix for old clients.
+    def _window_functions(self, server_info):
+        if server_info is None:
+            return False
+        mariadb = 'mariadb' in server_info.lower()
+        if mariadb and server_info.startswith('5.5.5-'):
+            server_info = server_info[len('5.5.5-'):]
+        version = tuple([int(part) for part in re.findall('\\d+', server_info)[:2]])
+        if mariadb:
+            return version >= (10, 2)
+        return version >= (8, 0)
+
+    # Return the snapshot of a host, holding its connection. Each host is queried
+    # by a single worker thread at a time.
+    def snapshot(self, host):
+        snapshot = self.snapshots.get(host)
+        if snapshot is None:
+            snapshot = mysqlsnapshot.HostSnapshot()
+            with self.lock:
+                self.snapshots[host] = snapshot
+        return snapshot
+
+    # Connect to the database, reusing the connection to the host if still alive.
+    # Returns None if unable to connect.
+    def connect(self, host, params):
+        try:
+            start = time.time()
+            conn, reused = self.snapshot(host).connect(params)
         except MySQLError, e:
             self.log.error('MySQLPerfSchemaCollector couldnt connect to database %s', e)
-            return False
-        return True
+            return None
+        if reused:
+            with self.lock:
+                self.reuses = self.reuses + 1
+            self.log.debug('MySQLPerfSchemaCollector: Reusing connection to %s:%s.', params['host'], params['port'])
+            return conn
 
-    # Disconnect from the database
-    def disconnect(self):
-        self.db.close()
+        self._add_stat(host, 'connect_ms', (time.time() - start) * 1000)
+        self.log.debug('MySQLPerfSchemaCollector: Connected to database.')
+        with self.lock:
+            self.connects = self.connects + 1
+        return conn
 
-    # Execute the query
-    def get_db_stats(self, query):
+    # Close the connections to all the hosts, called on shutdown
+    def close_connections(self):
+        with self.lock:
+            snapshots = self.snapshots
+            self.snapshots = {}
+        for snapshot in snapshots.values():
+            snapshot.reset()
 
-        cursor = self.db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    # Execute the batched query and yield (source, rows, reset) for each enabled source,
+    # in order. If streaming, rows is an iterator over a server side cursor holding at
+    # most fetch_size rows in memory, which must be consumed before the next source.
+    # reset is True if the server was restarted since the previous collection.
+    def iter_sources(self, host, conn, query, params, deadline, streaming):
+        if streaming:
+            cursor = conn.cursor(cursorclass=MySQLdb.cursors.SSCursor)
+        else:
+            cursor = conn.cursor(cursorclass=MySQLdb.cursors.Cursor)
         try:
-            cursor.execute(query)
-            return cursor.fetchall()
-        except MySQLError, e:
-            self.log.error('MySQLPerfSchemaCollector could not get performance schema stats', e)
-            return ()
-
-    # Parse the results and stores them into a dictionary
-    def _get_table_stats(self, query_table_stats):
-        metrics = {}
-
-        results = self.get_db_stats(query_table_stats)
-        for r in results:
-            db = r['object_schema'] # database name
-            table = r['object_name'] # table name
-            # counters
-            metrics['table.total.{0}.{1}'.format(db, table)] = r['count_star']
-            metrics['table.reads.{0}.{1}'.format(db, table)] = r['count_read']
-            metrics['table.writes.{0}.{1}'.format(db, table)] = r['count_write']
-            metrics['table.inserts.{0}.{1}'.format(db, table)] = r['count_insert']
-            metrics['table.updates.{0}.{1}'.format(db, table)] = r['count_update']
-            metrics['table.deletes.{0}.{1}'.format(db, table)] = r['count_delete']
+            try:
+                start = time.time()
+                cursor.execute(*query)
+                row = cursor.fetchone()
+                self._add_stat(host, 'execute_ms', (time.time() - start) * 1000)
+                reset = self._restarted(host, row and int(row[-1]))
+                for source in self.sources:
+                    check_deadline(params, deadline)
+                    # the statements of the batch are executed by the server as the results are read
+                    start = time.time()
+                    cursor.nextset()
+                    if streaming:
+                        self._add_stat(host, source.name + '.fetch_ms', (time.time() - start) * 1000)
+                        yield source, self._iter_rows(host, source, cursor), reset
+                    else:
+                        rows = cursor.fetchall()
+                        self._add_stat(host, source.name + '.fetch_ms', (time.time() - start) * 1000)
+                        self._add_stat(host, source.name + '.rows', len(rows))
+                        yield source, rows, reset
+            except MySQLError, e:
+                # the following results of the batch are lost, let the caller handle the host failure
+                self.log.error('MySQLPerfSchemaCollector could not get performance schema stats: %s', e)
+                raise
+        finally:
+            cursor.close()
 
-        return metrics
+    # Return True if the server was restarted since the previous sample of the host,
+    # or since the counter state was saved for the first sample
+    def _restarted(self, host, uptime):
+        now = time.time()
+        if uptime is None:
+            return False
+        previous = self.uptimes.get(host)
+        self.uptimes[host] = (uptime, now)
+        if previous is not None:
+            return uptime < previous[0]
+        if self.counters is not None and self.counters.saved is not None:
+            return uptime < now - self.counters.saved
+        return False
 
-    def _get_index_stats(self, query_index_stats):
-        metrics = {}
+    def _iter_rows(self, host, source, cursor):
+        fetch_size = int(self.config['fetch_size'])
+        while True:
+            start = time.time()
+            rows = cursor.fetchmany(fetch_size)
+            self._add_stat(host, source.name + '.fetch_ms', (time.time() - start) * 1000)
+            if not rows:
+                break
+            self._add_stat(host, source.name + '.rows', len(rows))
+            for row in rows:
+                yield row
 
-        results = self.get_db_stats(query_index_stats)
-        for r in results:
-            db = r['object_schema'] # database name
-            table = r['object_name'] # table name
-            index = r['index_name'] #index
+    # Add value to a statistic of the current cycle of a host. The statistics of
+    # a host are only updated by the thread querying it.
+    def _add_stat(self, host, name, value):
+        stats = self.host_stats.setdefault(host, {})
+        stats[name] = stats.get(name, 0) + value
 
-            if db == 'performance_schema': # ignore performance schema
-                continue
+    # Publish the metrics of the rows of a source, returns the number of published
+    # metrics. The metric names of each key are looked up in the cache of the
+    # previous cycle and stored into names, which becomes the cache of the next cycle.
+    def _publish_rows(self, source, rows, names, reset=False):
+        if source.ranked:
+            return self._publish_ranked(source, rows, reset)
+        if self.rollup and source.schema and source.counter:
+            return self._publish_rollup(source, rows, names, reset)
+        counter = 0L
+        previous = self.metric_names.get(source.name, {})
+        keys = len(source.keys)
+        values = range(len(source.metrics))
+        latencies = []
+        if self.latency:
+            latencies = range(len(source.latencies))
+        offset = keys + len(source.metrics)
+        slowest = []
+        top = 0
+        if source.slowest and latencies:
+            top = int(self.config[source.slowest])
+        for r in rows:
+            key = r[:keys]
+            metric_names = previous.get(key)
+            if metric_names is None:
+                metric_names = source.metric_names(key)
+            names[key] = metric_names
+            for i in values:
+                value = r[keys + i]
+                if value is None:
+                    continue
+                if not source.counter:
+                    self.publish(metric_names[i], value)
+                    counter = counter + 1L
+                elif self._publish_counter(metric_names[i], value, reset):
+                    counter = counter + 1L
+            for i in latencies:
+                name = metric_names[offset - keys + i]
+                latency = self._latency(name, r[offset + 2 * i], r[offset + 2 * i + 1], reset)
+                if latency is None:
+                    continue
+                self.publish(name, latency, precision=3)
+                counter = counter + 1L
+                # keep the `top` rows with the highest latency in a min-heap
+                if i == 0 and top > 0:
+                    if len(slowest) < top:
+                        heapq.heappush(slowest, (latency, key))
+                    elif latency > slowest[0][0]:
+                        heapq.heapreplace(slowest, (latency, key))
 
-            if index == 'None':
-                index = "NO_INDEX_USED"
-            # counters
-            metrics['index.total.{0}.{1}.{2}'.format(db, table, index)] = r['count_star']
-            metrics['index.reads.{0}.{1}.{2}'.format(db, table, index)] = r['count_read']
-            metrics['index.writes.{0}.{1}.{2}'.format(db, table, index)] = r['count_write']
+        metric = 'slowest.' + source.latencies[0] if slowest else None
+        for latency, key in slowest:
+            self.publish(source.metric_name(key, metric), latency, precision=3)
+            counter = counter + 1L
+        return counter
 
-        return metrics
+    # Publish the top K rows of a ranked source by each metric of rank. The rates of
+    # every row are tracked in the bounded digest store, only the names of the
+    # published rows are built. Returns the number of published metrics.
+    def _publish_ranked(self, source, rows, reset):
+        top = int(self.config[source.ranked])
+        keys = len(source.keys)
+        values = range(len(source.metrics))
+        heaps = [[] for i in source.rank]
+        for r in rows:
+            key = r[:keys]
+            # state names are not metric paths, they are never published
+            prefix = ' '.join([str(k) for k in key]) + ' '
+            rates = []
+            for i in values:
+                value = r[keys + i]
+                if value is None:
+                    rates.append(0.0)
+                else:
+                    rates.append(self.digests.update(prefix + source.metrics[i], value, self.now, reset)[0])
+            # new series, reset or no events in the interval
+            if not rates[0] or top <= 0:
+                continue
+            for heap, i in zip(heaps, source.rank):
+                if len(heap) < top:
+                    heapq.heappush(heap, (rates[i], key, rates))
+                elif rates[i] > heap[0][0]:
+                    heapq.heapreplace(heap, (rates[i], key, rates))
 
+        published = {}
+        for heap in heaps:
+            for rank, key, rates in heap:
+                published[key] = rates
+        counter = 0L
+        for key, rates in published.iteritems():
+            for i in values:
+                self.publish(source.metric_name(key, source.metrics[i]), rates[i], precision=3)
+            self.publish(source.metric_name(key, 'latency_ms'), rates[1] / rates[0], precision=3)
+            counter = counter + len(values) + 1
+        return counter
+
+    # Publish the rows of a source rolled up per schema and per host. Only the rollup_top
+    # rows with the highest activity are published individually, the others are summed
+    # up under _other. Rates are summed, the latency of a rollup is the ratio of the
+    # summed timer and count deltas. Returns the number of published metrics.
+    def _publish_rollup(self, source, rows, names, reset):
+        previous = self.metric_names.get(source.name, {})
+        keys = len(source.keys)
+        metrics = len(source.metrics)
+        latencies = []
+        if self.latency:
+            latencies = range(len(source.latencies))
+        activity = list(source.columns).index(source.activity)
+        rollup = Rollup(int(self.config['rollup_top']))
+        for r in rows:
+            key = r[:keys]
+            metric_names = previous.get(key)
+            if metric_names is None:
+                metric_names = source.metric_names(key)
+            names[key] = metric_names
+            values = []
+            for i in range(metrics):
+                value = r[keys + i]
+                if value is not None:
+                    value = self.counters.update(metric_names[i], value, self.now, reset)[0]
+                values.append(value)
+            # timer and count deltas of each latency
+            for i in latencies:
+                offset = keys + metrics + 2 * i
+                deltas = self._latency_deltas(metric_names[metrics + i], r[offset], r[offset + 1], reset)
+                values.extend(deltas or (None, None))
+            rollup.add(key[0], key, values[activity] or 0, values)
 
-    def _publish_stats(self, metrics):
+        series = [(key, values) for rank, key, values in rollup.rows()]
+        for schema in sorted(rollup.schemas.keys()):
+            series.append(((schema,) + ('_total',) * (keys - 1), rollup.schemas[schema]))
+        if rollup.schemas:
+            series.append((('_total',) * keys, rollup.total()))
+        if rollup.other is not None:
+            series.append((('_other',) * keys, rollup.other))
 
         counter = 0L
-        for key, value in metrics.items():
+        for key, values in series:
+            for i in range(metrics):
+                if values[i] is not None:
+                    self.publish(source.metric_name(key, source.metrics[i]), values[i])
+                    counter = counter + 1L
+            for i in latencies:
+                delta_total = values[metrics + 2 * i]
+                delta_count = values[metrics + 2 * i + 1]
+                if delta_count and delta_total is not None:
+                    self.publish(source.metric_name(key, source.latencies[i]),
+                                 delta_total / delta_count / 1e9, precision=3)
+                    counter = counter + 1L
+        return counter
+
+    # Return the mean latency in milliseconds of the events counted since the previous
+    # collection, None if there were no events or the counters were reset
+    def _latency(self, name, total, count, reset):
+        deltas = self._latency_deltas(name, total, count, reset)
+        if deltas is None:
+            return None
+        # timers are in picoseconds
+        return deltas[0] / deltas[1] / 1e9
+
+    # Return the (timer, count) deltas of a latency since the previous collection,
+    # None if there were no events or the counters were reset
+    def _latency_deltas(self, name, total, count, reset):
+        if total is None or count is None:
+            return None
+        # the state is not published, so it is kept under names that are not valid metric paths
+        delta_total = self.counters.delta(name + ' sum', total, self.now, reset)
+        delta_count = self.counters.delta(name + ' count', count, self.now, reset)
+        if not delta_count or delta_total is None:
+            return None
+        return delta_total, delta_count
+
+    # Publish the rate of a single counter. Series whose rate has been zero for more
+    # than suppress_zero_cycles collections are only published as a periodic heartbeat,
+    # the first non-zero rate is published right away. Returns False if suppressed.
+    def _publish_counter(self, key, value, reset=False):
+        if self.counters is not None:
+            rate, zeros = self.counters.update(key, value, self.now, reset)
+            idle = zeros - self.suppress_zero_cycles
+            if self.suppress_zero_cycles > 0 and idle > 0 and idle % self.zero_heartbeat_cycles != 0:
+                self.suppressed = self.suppressed + 1
+                return False
+        else:
             rate = self.derivative(key, value)
-            self.publish(key, rate)
-            counter = counter + 1L
-            self.log.debug('%s = %d', key, rate)
+        self.publish(key, rate)
+        self.log.debug('%s = %d', key, rate)
+        return True
+
+    # Read the rows of all the enabled sources. Returns a list of (source, rows, reset),
+    # None if unable to connect.
+    def get_stats(self, host, params, deadline=None):
+
+        snapshot = self.snapshot(host)
+        try:
+            conn = self.connect(host, params)
+            if conn is None:
+                return None
+
+            check_deadline(params, deadline)
+            query = self._get_query(host, params, snapshot)
+            return list(self.iter_sources(host, conn, query, params, deadline, False))
+        except Exception:
+            # the connection may be in an unknown state, open a new one next time
+            snapshot.reset()
+            raise
+
+    # Same as get_stats(), but the metrics are published while reading the rows.
+    # Returns the number of published metrics, None if unable to connect.
+    def stream_stats(self, host, params, deadline, names):
+
+        snapshot = self.snapshot(host)
+        try:
+            conn = self.connect(host, params)
+            if conn is None:
+                return None
+
+            check_deadline(params, deadline)
+            query = self._get_query(host, params, snapshot)
+            counter = 0L
+            for source, rows, reset in self.iter_sources(host, conn, query, params, deadline, True):
+                counter = counter + self._publish_rows(source, rows, names[source.name], reset)
+        except Exception:
+            snapshot.reset()
+            raise
+        self._add_stat(host, 'metrics', counter)
 
         self.log.debug('Published %d metrics', counter)
+        return counter
+
+    # Query a single host, executed by the worker threads unless streaming. Never raises,
+    # returns None if the host was skipped or failed. In streaming mode names holds the
+    # metric name caches of the sources.
+    def _collect_host(self, host_params, names=None):
+        host, params = host_params
+        breaker = self.breakers[host]
+        now = time.time()
+        if not breaker.allow(now):
+            self.log.debug('Skipping %s:%s, circuit breaker open for %.0f more seconds',
+                           params['host'], params['port'], breaker.open_until - now)
+            return None
 
-    def get_stats(self, params, query_table_stats, query_index_stats):
+        if 'db' in params:
+            self.log.debug('Getting metrics for database: %s', params['db'])
+        else:
+            self.log.debug('Database not specified. Querying performance schema data about all schemas.')
 
-        # if unable to connect, return emtpty dict
-        if not self.connect(params):
-            return {}
+        deadline = None
+        if int(self.config['host_timeout']) > 0:
+            deadline = now + int(self.config['host_timeout'])
 
-        metrics = self._get_table_stats(query_table_stats)
-        metrics.update(self._get_index_stats(query_index_stats))
+        try:
+            if names is None:
+                metrics = self.get_stats(host, params, deadline)
+            else:
+                metrics = self.stream_stats(host, params, deadline, names)
+        except Exception, e:
+            self.log.error("Error %s", e)
+            self.log.error('Collection failed for %s', e)
+            metrics = None
 
+        if metrics is None:
+            self._add_stat(host, 'errors', 1)
+            breaker.failure(time.time())
+            if breaker.state(time.time()) == CircuitBreaker.OPEN:
+                self.log.error('Skipping %s:%s for %.0f seconds after %d consecutive failures',
+                               params['host'], params['port'], breaker.open_until - time.time(), breaker.failures)
+            return None
+
+        breaker.success()
         return metrics
 
+    # Publish the peak, median, 95th and 99th percentile of the rates sampled by the
+    # burst samplers since the previous collection, for the burst_top rows of each
+    # source with the highest peak
+    def _publish_bursts(self):
+        top = int(self.config['burst_top'])
+        for host, params in self.host_params:
+            sampler = self.samplers.get(host)
+            if sampler is None:
+                continue
+            rates, stats = sampler.drain()
+            for name, value in stats.items():
+                self._add_stat(host, 'burst.' + name, value)
+            counter = 0L
+            for source in sampler.sources:
+                metric = source.metrics[list(source.columns).index(source.activity)]
+                peaks = []
+                for key, series in rates[source.name].iteritems():
+                    series.sort()
+                    if top <= 0 or len(peaks) < top:
+                        heapq.heappush(peaks, (series[-1], key, series))
+                    elif series[-1] > peaks[0][0]:
+                        heapq.heapreplace(peaks, (series[-1], key, series))
+                for peak, key, series in peaks:
+                    self.publish(source.metric_name(key, metric + '_peak'), peak, precision=3)
+                    for percentile in (50, 95, 99):
+                        # nearest rank
+                        rank = int(math.ceil(len(series) * percentile / 100.0)) - 1
+                        self.publish(source.metric_name(key, '%s_p%d' % (metric, percentile)),
+                                     series[rank], precision=3)
+                    counter = counter + 4
+            self._add_stat(host, 'metrics', counter)
+
+    # Publish the circuit breaker state of every host
+    def _publish_breakers(self):
+        now = time.time()
+        for host, params in self.host_params:
+            breaker = self.breakers[host]
+            name = self._host_name(params)
+            self.publish('breaker.{0}.state'.format(name), breaker.state(now))
+            self.publish('breaker.{0}.failures'.format(name), breaker.failures)
+            self.publish('breaker.{0}.trips'.format(name), breaker.trips)
+
+    # Publish the statistics of every host queried in this cycle and the duration
+    # of the collection, also relative to the interval
+    def _publish_self_metrics(self, duration):
+        path = self.config['self_metrics_path']
+        for host, params in self.host_params:
+            stats = self.host_stats.get(host)
+            if stats is None:
+                continue
+            prefix = '{0}.{1}.'.format(path, self._host_name(params))
+            for name in sorted(stats.keys()):
+                self.publish(prefix + name, stats[name], precision=3)
+        self.publish(path + '.duration_ms', duration * 1000, precision=3)
+        self.publish(path + '.interval_usage', duration / float(self.config['interval']), precision=3)
+
+    def _host_name(self, params):
+        return re.sub('[:\. /]', '_', '%s:%s' % (params['host'], params['port']))
+
     # Collect the metrics
     def collect(self):
 
@@ -138,48 +1343,63 @@ class MySQLPerfSchemaCollector(diamond.collector.Collector):
             self.log.error('Unable to import MySQLdb')
             return False
 
-        for host in self.config['hosts']:
-            matches = re.search('^([^:]*):([^@]*)@([^:]*):?([^/]*)/([^/]*)/?(.*)', host)
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            mysqlsnapshot.on_shutdown(self.shutdown)
+        self.start_samplers()
+        self.connects = 0
+        self.reuses = 0
+        self.now = time.time()
+        self.suppressed = 0
+        self.host_stats = {}
+        for host, params in self.host_params:
+            self.host_stats[host] = {'errors': 0, 'metrics': 0}
+        if self.counters is not None:
+            evicted = self.counters.next_cycle()
+            if evicted:
+                self.log.debug('Evicted %d idle counters', evicted)
+        evicted = self.digests.next_cycle()
+        if evicted:
+            self.log.debug('Evicted %d statement digests', evicted)
 
-            if not matches:
-                self.log.error('Connection string not in required format, skipping: %s', host)
-                continue
+        names = {}
+        for source in self.sources:
+            names[source.name] = {}
 
-            params = {}
+        if str_to_bool(self.config['streaming']):
+            # rows are published as they are read, so they have to be read by the collector thread
+            for host_params in self.host_params:
+                self._collect_host(host_params, names)
+        else:
+            # query the hosts concurrently, then publish from the collector thread in a fixed order
+            results = map_hosts(self._collect_host, self.host_params, int(self.config['max_workers']), self.name)
+            for (host, params), results in zip(self.host_params, results):
+                if results is None:
+                    continue
+                counter = 0L
+                for source, rows, reset in results:
+                    counter = counter + self._publish_rows(source, rows, names[source.name], reset)
+                self._add_stat(host, 'metrics', counter)
+                self.log.debug('Published %d metrics', counter)
 
-            params['host'] = matches.group(3)
-            try:
-                params['port'] = int(matches.group(4))
-            except ValueError:
-                params['port'] = 3306
-            params['db'] = matches.group(5)
-            params['user'] = matches.group(1)
-            params['passwd'] = matches.group(2)
-
-            # If no database is selected, get data about all databases
-            query_table_stats = self._STATS_ALL_DATABASES
-            query_index_stats = self._INDEX_ALL_DATABASES
-
-            if params['db'] == 'None':
-                del params['db']
-                self.log.debug('Database not specified. Querying performance schema data about all schemas.')
-                # query all stats
-            else:
-                query_table_stats = self._TABLE_STATS.format(params['db'])
-                query_index_stats = self._INDEX_STATS.format(params['db'])
-                self.log.debug('Getting metrics for database: %s', params['db'])
+        # drop the names of the objects that no longer exist
+        self.metric_names = names
 
-            try:
-                metrics = self.get_stats(params, query_table_stats, query_index_stats)
-                if len(metrics) == 0:
-                    self.log.debug('Empty metric set.')
-                else:
-                    self.log.debug('Publishing %d metrics', len(metrics))
-                    self._publish_stats(metrics)
-            except Exception, e:
-                try:
-                    self.log.error("Error %s", e)
-                    self.disconnect()
-                except MySQLdb.ProgrammingError:
-                    pass
-                self.log.error('Collection failed for %s', e)
+        self.log.debug('Opened %d connections, reused %d', self.connects, self.reuses)
+        self.publish('connections.opened', self.connects)
+        self.publish('connections.reused', self.reuses)
+        self._publish_breakers()
+        self._publish_bursts()
+
+        if self.counters is not None:
+            self.publish('counters.series', len(self.counters))
+            if self.suppress_zero_cycles > 0:
+                self.publish('counters.suppressed', self.suppressed)
+            save_cycles = int(self.config['counter_state_save_cycles'])
+            if save_cycles > 0 and self.counters.cycle % save_cycles == 0:
+                self.save_counter_state()
+        if len(self.digests):
+            self.publish('statements.series', len(self.digests))
+
+        if str_to_bool(self.config['self_metrics']):
+            self._publish_self_metrics(time.time() - self.now)
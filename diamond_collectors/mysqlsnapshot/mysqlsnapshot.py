@@ -0,0 +1,221 @@
+# coding=utf-8
+
+"""
+Code shared by MySQLSizeCollector and MySQLPerfSchemaCollector
+
+A HostSnapshot holds the connection of a collector to a host, kept across
+collections, together with the server version read once per connection. The
+connection is opened with CLIENT.MULTI_STATEMENTS. Diamond 4 runs each collector
+in its own process, so nothing is shared between the collectors at runtime:
+every collector keeps its own snapshot of each of its hosts.
+
+The module also holds what both collectors need besides the connection: the
+time budget of a host, its circuit breaker, the pool of threads querying the
+hosts, the rollup of the rows and the shutdown hook.
+
+This module is not a collector, Diamond only imports it. It has to be installed
+in the collectors_path next to the collectors, see README.md.
+"""
+
+try:
+    import MySQLdb
+    from MySQLdb import MySQLError
+    from MySQLdb.constants import CLIENT
+except ImportError:
+    MySQLdb = None
+import atexit
+import heapq
+import Queue
+import re
+import signal
+import sys
+import threading
+import time
+
+
+# Raised when a host exceeds its time budget for the current collection
+class HostDeadlineExceeded(Exception):
+    pass
+
+
+# Tracks the consecutive failures of a host. After `threshold` failures the host
+# is skipped (open) for an exponentially growing backoff, then a single probe is
+# allowed (half open). A successful collection closes the breaker again.
+class CircuitBreaker(object):
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, threshold, backoff, max_backoff):
+        self.threshold = max(threshold, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.open_until = 0
+        self.trips = 0
+
+    def allow(self, now):
+        return now >= self.open_until
+
+    def state(self, now):
+        if self.failures < self.threshold:
+            return self.CLOSED
+        if now < self.open_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def success(self):
+        self.failures = 0
+        self.open_until = 0
+
+    def failure(self, now):
+        self.failures = self.failures + 1
+        if self.failures >= self.threshold:
+            exponent = min(self.failures - self.threshold, 30)
+            self.open_until = now + min(self.backoff * (2 ** exponent), self.max_backoff)
+            self.trips = self.trips + 1
+
+
+# Rolls up the rows of a host: the sums of the values of each schema and of all
+# the other rows than the `top` rows with the highest rank. Memory is bounded by
+# the number of schemas and top, not by the number of rows.
+class Rollup(object):
+
+    def __init__(self, top):
+        self.top = top
+        self.schemas = {}
+        self.heap = []
+        self.other = None
+
+    def add(self, schema, key, rank, values):
+        totals = self.schemas.get(schema)
+        if totals is None:
+            totals = self.schemas[schema] = [0] * len(values)
+        self._sum(totals, values)
+        if len(self.heap) < self.top:
+            heapq.heappush(self.heap, (rank, key, values))
+            return
+        if self.heap and rank > self.heap[0][0]:
+            rank, key, values = heapq.heapreplace(self.heap, (rank, key, values))
+        if self.other is None:
+            self.other = [0] * len(values)
+        self._sum(self.other, values)
+
+    # Sums of the values of all the rows
+    def total(self):
+        total = None
+        for totals in self.schemas.values():
+            if total is None:
+                total = [0] * len(totals)
+            self._sum(total, totals)
+        return total
+
+    # (rank, key, values) of the top rows, highest rank first
+    def rows(self):
+        return sorted(self.heap, reverse=True)
+
+    def _sum(self, sums, values):
+        for i, value in enumerate(values):
+            if value is not None:
+                sums[i] = sums[i] + value
+
+
+# Raise HostDeadlineExceeded if the time budget of the host is over
+def check_deadline(params, deadline):
+    if deadline is not None and time.time() > deadline:
+        raise HostDeadlineExceeded('time budget exceeded for %s:%s' % (params['host'], params['port']))
+
+
+# Apply func to every item using at most max_workers threads, named after the
+# collector. Results are returned in the same order as the items.
+def map_hosts(func, items, max_workers, name):
+    workers = min(max_workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = func(item)
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=worker, name='%s-worker-%d' % (name, i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Call func when the current process shuts down, on exit or on SIGTERM. Diamond 4
+# builds the collectors in the server process and runs each of them in a forked
+# child, which leaves with os._exit() on SIGTERM: its atexit hooks never run, and
+# those of the server run on a copy of the collector that never collected. The
+# collectors therefore call this from the process that collects.
+def on_shutdown(func):
+    atexit.register(func)
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def terminate(signum, frame):
+            func()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                sys.exit(128 + signum)
+
+        signal.signal(signal.SIGTERM, terminate)
+    except ValueError:
+        # not the main thread, only the atexit hook is left
+        pass
+
+
+# Connection of a collector to a host and the version of the server
+class HostSnapshot(object):
+
+    def __init__(self):
+        self.conn = None
+        self.server_info = None
+        self.version = None
+
+    # Return (connection, reused), reusing the connection of the host if still
+    # alive. Raises MySQLError if unable to connect.
+    def connect(self, params):
+        if self.conn is not None:
+            try:
+                self.conn.ping()
+                return self.conn, True
+            except MySQLError:
+                self.reset()
+
+        params = dict(params)
+        params['client_flag'] = params.get('client_flag', 0) | CLIENT.MULTI_STATEMENTS
+        conn = MySQLdb.connect(**params)
+        self.conn = conn
+        self.server_info = conn.get_server_info()
+        self.version = tuple([int(part) for part in re.findall('\\d+', self.server_info)[:2]])
+        return conn, False
+
+    # Close the connection, e.g., after an error left it in an unknown state. The
+    # server may have been upgraded in the meantime.
+    def reset(self):
+        conn = self.conn
+        self.conn = None
+        self.server_info = None
+        self.version = None
+        if conn is not None:
+            try:
+                conn.close()
+            except MySQLError:
+                pass
@@ -0,0 +1,338 @@
+# coding=utf-8
+
+"""
+
+Diamond handler that sends metrics to Graphite and spools them to disk while
+carbon is unreachable
+
+#### Considerations
+
+The stock GraphiteHandler keeps a single connection with a blocking timeout
+(15s in diamond.conf) and drops the metrics it cannot send, and the queue
+between the collectors and the handlers only holds `metric_queue_size`
+metrics. A carbon restart therefore blocks the collectors or loses metrics.
+
+This handler sends the metrics in batches of `batch` points over a persistent
+connection, using the plaintext or the pickle protocol. A batch that cannot be
+sent is appended to a spool: a ring file of `spool_size_mb` MB mapped in
+memory. When the spool is full the oldest batches are evicted to make room.
+The spool survives a restart of Diamond.
+
+Once carbon is reachable again, live batches are always sent first. After each
+of them, and at each flush, the backlog is replayed, oldest first, at up to
+`replay_rate` points per second, so that a long outage does not flood carbon
+nor delay the live metrics. Diamond flushes the handlers once per collector
+run, so the replay budget accrues between flushes, up to `replay_burst`
+seconds of it: set it to at least the `interval` of the collectors for the
+replay to reach `replay_rate`. While the connection is down it is retried at
+most every `reconnect_interval` seconds, so that the collectors are not
+blocked.
+
+#### Customizing
+
+Place the handler in the `handlers_path` of diamond.conf
+(/usr/share/diamond/handlers/) and enable it in place of GraphiteHandler:
+
+    [server]
+    handlers = spoolgraphite.SpoolGraphiteHandler
+
+    [handlers]
+    [[SpoolGraphiteHandler]]
+    host = 127.0.0.1
+    port = 2004
+    protocol = pickle
+    batch = 256
+    spool_path = /var/lib/diamond/graphite.spool
+    spool_size_mb = 64
+    replay_rate = 2000
+    replay_burst = 60
+
+"""
+
+import mmap
+import os
+import pickle
+import select
+import socket
+import struct
+import time
+
+from diamond.handler.Handler import Handler
+
+SPOOL_MAGIC = 'DSPOOL01'
+# magic, capacity, head, tail, records, evicted records
+SPOOL_HEADER = struct.Struct('<8sQQQQQ')
+SPOOL_HEADER_SIZE = 64
+# length of a record
+RECORD = struct.Struct('<I')
+
+
+# Ring of records in a memory mapped file. head and tail are the positions of
+# the oldest record and of the end of the newest record: they only grow, the
+# offset in the ring is position % capacity. A record is its length followed
+# by its bytes, and can wrap around the end of the ring.
+class Spool(object):
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        size = SPOOL_HEADER_SIZE + capacity
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        f = open(path, 'r+b')
+        try:
+            if os.fstat(f.fileno()).st_size != size:
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        finally:
+            f.close()
+
+        magic, capacity, self.head, self.tail, self.records, self.evicted = \
+            SPOOL_HEADER.unpack_from(self.map, 0)
+        if magic != SPOOL_MAGIC or capacity != self.capacity or not \
+                0 <= self.tail - self.head <= self.capacity:
+            # new file, resized or corrupted spool
+            self.head = self.tail = self.records = self.evicted = 0
+            self._save()
+
+    def _save(self):
+        SPOOL_HEADER.pack_into(self.map, 0, SPOOL_MAGIC, self.capacity, self.head, self.tail,
+                               self.records, self.evicted)
+
+    def used(self):
+        return self.tail - self.head
+
+    def _write(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = SPOOL_HEADER_SIZE + offset
+        self.map[start:start + first] = data[:first]
+        if first < len(data):
+            self.map[SPOOL_HEADER_SIZE:SPOOL_HEADER_SIZE + len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        offset = position % self.capacity
+        first = min(length, self.capacity - offset)
+        start = SPOOL_HEADER_SIZE + offset
+        data = self.map[start:start + first]
+        if first < length:
+            data = data + self.map[SPOOL_HEADER_SIZE:SPOOL_HEADER_SIZE + length - first]
+        return data
+
+    # Append a record, evicting the oldest ones if needed. Return the number of
+    # evicted records, or -1 if the record is larger than the spool.
+    def append(self, data):
+        size = RECORD.size + len(data)
+        if size > self.capacity:
+            return -1
+        evicted = 0
+        while self.used() + size > self.capacity:
+            self._pop()
+            evicted = evicted + 1
+        self._write(self.tail, RECORD.pack(len(data)))
+        self._write(self.tail + RECORD.size, data)
+        self.tail = self.tail + size
+        self.records = self.records + 1
+        self.evicted = self.evicted + evicted
+        self._save()
+        return evicted
+
+    # Return the oldest record, or None if the spool is empty
+    def peek(self):
+        if self.head == self.tail:
+            return None
+        length = RECORD.unpack(self._read(self.head, RECORD.size))[0]
+        return self._read(self.head + RECORD.size, length)
+
+    # Remove the oldest record
+    def pop(self):
+        if self.head != self.tail:
+            self._pop()
+            self._save()
+
+    def _pop(self):
+        length = RECORD.unpack(self._read(self.head, RECORD.size))[0]
+        self.head = self.head + RECORD.size + length
+        self.records = self.records - 1
+        if self.head == self.tail:
+            # restart from the beginning of the file, so that the next records do not wrap
+            self.head = self.tail = 0
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class SpoolGraphiteHandler(Handler):
+
+    def __init__(self, config=None):
+        Handler.__init__(self, config)
+
+        self.host = self.config['host']
+        self.protocol = self.config['protocol']
+        port = self.config['port']
+        if port is None or port == '':
+            port = self.protocol == 'pickle' and 2004 or 2003
+        self.port = int(port)
+        self.timeout = float(self.config['timeout'])
+        self.batch_size = int(self.config['batch'])
+        self.reconnect_interval = float(self.config['reconnect_interval'])
+        self.replay_rate = float(self.config['replay_rate'])
+        self.replay_burst = float(self.config['replay_burst'])
+
+        self.spool = Spool(self.config['spool_path'], int(float(self.config['spool_size_mb']) * 1024 * 1024))
+        if self.spool.records:
+            self.log.info('SpoolGraphiteHandler: %d batches (%d bytes) to replay from %s',
+                          self.spool.records, self.spool.used(), self.spool.path)
+
+        # plaintext lines of the batch being filled
+        self.batch = []
+        self.socket = None
+        self.retry_at = 0
+        # replay budget, in points, refilled at replay_rate up to replay_burst seconds
+        self.tokens = 0.0
+        self.tokens_at = time.time()
+        self._connect()
+
+    def get_default_config_help(self):
+        config = super(SpoolGraphiteHandler, self).get_default_config_help()
+        config.update({
+            'host': 'Hostname',
+            'port': 'Port, 2003 for plaintext and 2004 for pickle if empty',
+            'protocol': 'plaintext or pickle',
+            'timeout': 'Socket timeout in seconds',
+            'batch': 'Points per batch',
+            'reconnect_interval': 'Seconds between connection attempts while carbon is unreachable',
+            'spool_path': 'Spool file, where the batches are kept while carbon is unreachable',
+            'spool_size_mb': 'Size of the spool file in MB, the oldest batches are evicted beyond it',
+            'replay_rate': 'Maximum points per second replayed from the spool',
+            'replay_burst': 'Seconds of replay budget accrued between flushes, at least the interval ' +
+                            'of the collectors',
+        })
+        return config
+
+    def get_default_config(self):
+        config = super(SpoolGraphiteHandler, self).get_default_config()
+        config.update({
+            'host': 'localhost',
+            'port': '',
+            'protocol': 'plaintext',
+            'timeout': 15,
+            'batch': 256,
+            'reconnect_interval': 10,
+            'spool_path': '/var/lib/diamond/graphite.spool',
+            'spool_size_mb': 64,
+            'replay_rate': 1000,
+            'replay_burst': 60,
+        })
+        return config
+
+    def __del__(self):
+        self._close()
+
+    def process(self, metric):
+        self.batch.append(str(metric))
+        if len(self.batch) >= self.batch_size:
+            self._send_batch()
+
+    def flush(self):
+        if self.batch:
+            self._send_batch()
+        elif self.spool.records:
+            self._replay()
+        self.spool.flush()
+
+    def _send_batch(self):
+        data = ''.join(self.batch)
+        points = len(self.batch)
+        self.batch = []
+        if not self._send(data):
+            evicted = self.spool.append(data)
+            if evicted < 0:
+                self.log.error('SpoolGraphiteHandler: dropping a batch of %d points larger than the spool',
+                               points)
+            elif evicted:
+                self.log.warning('SpoolGraphiteHandler: spool full, evicted the %d oldest batches', evicted)
+            return
+        self._replay()
+
+    # Send the oldest batches of the spool within the replay budget
+    def _replay(self):
+        now = time.time()
+        # the flushes are sparse, the budget accrues over the time elapsed since the previous one
+        self.tokens = min(self.tokens + (now - self.tokens_at) * self.replay_rate,
+                          self.replay_rate * max(self.replay_burst, 1))
+        self.tokens_at = now
+        while self.tokens > 0:
+            data = self.spool.peek()
+            if data is None:
+                return
+            if not self._send(data):
+                return
+            self.spool.pop()
+            self.tokens = self.tokens - data.count('\n')
+            if self.spool.records == 0:
+                self.log.info('SpoolGraphiteHandler: spool replayed')
+
+    def _encode(self, data):
+        if self.protocol != 'pickle':
+            return data
+        points = []
+        for line in data.splitlines():
+            path, value, timestamp = line.split()
+            points.append((path, (int(timestamp), float(value))))
+        payload = pickle.dumps(points, 2)
+        return struct.pack('!L', len(payload)) + payload
+
+    # Send plaintext lines, return False if carbon is unreachable
+    def _send(self, data):
+        if self.socket is not None and self._closed_by_peer():
+            self.log.info('SpoolGraphiteHandler: connection closed by %s:%d', self.host, self.port)
+            self._close()
+        if self.socket is None and not self._connect():
+            return False
+        try:
+            self.socket.sendall(self._encode(data))
+        except socket.error, e:
+            self.log.error('SpoolGraphiteHandler: failed sending to %s:%d: %s', self.host, self.port, e)
+            self._close()
+            self.retry_at = time.time() + self.reconnect_interval
+            return False
+        return True
+
+    # carbon never writes to the socket: it is readable only once closed. Without
+    # this check the first batch after a carbon restart would be written to the
+    # old connection and lost.
+    def _closed_by_peer(self):
+        try:
+            readable = select.select([self.socket], [], [], 0)[0]
+        except (select.error, socket.error):
+            return True
+        return len(readable) > 0
+
+    def _connect(self):
+        if time.time() < self.retry_at:
+            return False
+        try:
+            self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error, e:
+            self.log.error('SpoolGraphiteHandler: failed connecting to %s:%d: %s', self.host, self.port, e)
+            self.socket = None
+            self.retry_at = time.time() + self.reconnect_interval
+            return False
+        self.log.debug('SpoolGraphiteHandler: connected to %s:%d', self.host, self.port)
+        return True
+
+    def _close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
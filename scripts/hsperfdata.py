@@ -0,0 +1,164 @@
+# coding=utf-8
+
+"""
+Reader of the hsperfdata files, where HotSpot JVMs export the performance
+counters read by jps and jstat: /tmp/hsperfdata_<user>/<pid>. The file is
+memory mapped by the JVM, which updates the counters in place.
+
+The file is parsed once into an index of the offset of every counter. The
+counters needed at each tick are then read from the mapping with a single
+precompiled struct, without running any process or parsing the file again.
+The index is rebuilt when the JVM adds counters.
+
+Only the version 2 format (Java 6 and later) is supported. JVMs started with
+-XX:-UsePerfData do not create the file. The files are readable only by the
+user running the JVM, and by root.
+"""
+
+import errno
+import mmap
+import os
+import struct
+
+MAGIC = 0xcafec0c0
+
+# magic, byte order, major version, minor version, accessible, used, overflow,
+# modification time stamp, entry offset, number of entries
+PROLOGUE = '%sIBBBBiiqii'
+PROLOGUE_SIZE = 32
+# entry length, name offset, vector length, data type, flags, units,
+# variability, data offset
+ENTRY = '%siiiBBBBi'
+
+TYPE_LONG = ord('J')
+TYPE_BYTE = ord('B')
+
+
+# Return [(pid, path)] of the hsperfdata files of the running JVMs under root
+def find_jvms(root='/tmp'):
+    jvms = []
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return jvms
+    for name in names:
+        if not name.startswith('hsperfdata_'):
+            continue
+        directory = os.path.join(root, name)
+        try:
+            files = os.listdir(directory)
+        except OSError:
+            # directory of another user
+            continue
+        for pid in files:
+            if pid.isdigit() and is_alive(int(pid)):
+                jvms.append((int(pid), os.path.join(directory, pid)))
+    jvms.sort()
+    return jvms
+
+
+# The file of a JVM that crashed is not removed
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class PerfData(object):
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic = struct.unpack_from('>I', self.map, 0)[0]
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not an hsperfdata file' % path)
+        # the byte order of the counters is the one of the platform of the JVM
+        self.order = self.map[4:5] == b'\x01' and '<' or '>'
+        self.prologue = struct.Struct(PROLOGUE % self.order)
+        self.entry = struct.Struct(ENTRY % self.order)
+        fields = self.prologue.unpack_from(self.map, 0)
+        if fields[2] != 2:
+            self.close()
+            raise ValueError('unsupported hsperfdata version %d.%d in %s' % (fields[2], fields[3], path))
+        self.entries = None
+        self.counters = {}
+        self.strings = {}
+        self.refresh()
+
+    # The JVM sets accessible once the counters are initialized
+    def accessible(self):
+        return self.prologue.unpack_from(self.map, 0)[4] == 1
+
+    # Rebuild the index if the JVM added counters, return True if it changed
+    def refresh(self):
+        fields = self.prologue.unpack_from(self.map, 0)
+        entry_offset, entries = fields[8], fields[9]
+        if entries == self.entries:
+            return False
+
+        counters = {}
+        strings = {}
+        offset = entry_offset
+        for i in range(entries):
+            length, name_offset, vector_length, data_type, flags, units, variability, data_offset = \
+                self.entry.unpack_from(self.map, offset)
+            end = self.map.find(b'\x00', offset + name_offset)
+            name = self.map[offset + name_offset:end].decode('ascii', 'replace')
+            if data_type == TYPE_LONG and vector_length == 0:
+                counters[name] = offset + data_offset
+            elif data_type == TYPE_BYTE and vector_length > 0:
+                strings[name] = (offset + data_offset, vector_length)
+            offset = offset + length
+        self.entries = entries
+        self.counters = counters
+        self.strings = strings
+        return True
+
+    def long(self, name):
+        return struct.unpack_from(self.order + 'q', self.map, self.counters[name])[0]
+
+    def string(self, name):
+        offset, length = self.strings[name]
+        value = self.map[offset:offset + length]
+        end = value.find(b'\x00')
+        if end >= 0:
+            value = value[:end]
+        return value.decode('utf-8', 'replace')
+
+    # Return a Reader of the counters among names that exist in this JVM
+    def reader(self, names):
+        return Reader(self, [name for name in names if name in self.counters])
+
+    def close(self):
+        self.map.close()
+
+
+# Reads a fixed set of counters with one unpack_from: the format skips the
+# bytes between the counters with pad bytes
+class Reader(object):
+
+    def __init__(self, perfdata, names):
+        self.map = perfdata.map
+        located = sorted([(perfdata.counters[name], name) for name in names])
+        self.names = tuple([name for offset, name in located])
+        self.base = located and located[0][0] or 0
+        fmt = [perfdata.order]
+        position = self.base
+        for offset, name in located:
+            if offset > position:
+                fmt.append('%dx' % (offset - position))
+            fmt.append('q')
+            position = offset + 8
+        self.struct = struct.Struct(''.join(fmt))
+
+    # Return the values of the counters, in the order of names
+    def read(self):
+        return self.struct.unpack_from(self.map, self.base)
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Sends the heap, GC, thread and class loading metrics of the running JVMs to
+Graphite. Replaces jmap_to_graphite.sh.
+
+The JVMs are discovered from their hsperfdata files, /tmp/hsperfdata_<user>/<pid>,
+and the ones whose command line (main class or jar and arguments) matches
+--match are monitored. Every --interval seconds (10 by default, 1 is cheap
+enough) their performance counters, the ones read by jstat, are read from the
+memory mapped files, see hsperfdata.py. No process is run and the JVMs are not
+stopped. The daemon must run as the user of the JVMs, or as root.
+
+The class histogram of `jmap -histo` walks the heap at a safepoint, and
+`jmap -histo:live` also forces a full GC, see
+http://netflix.github.io/spectator/en/latest/ext/jvm-gc-causes/#heap_inspection_initiated_gc
+They are therefore separate jobs, running in the background every
+--histo-interval and --live-histo-interval seconds (600 and 3600 by default,
+0 to disable). The histograms are parsed while jmap prints them, see
+ClassHistogram. Besides the totals, the --top-classes classes with the most
+bytes and with the most instances and the --top-growers classes whose bytes
+grew the most since the previous histogram can be published, to find leaks
+without taking heap dumps. Class names are sanitized: [Ljava.lang.String; is
+published as java_lang_String_array.
+
+The points of each tick are sent in a single batch over a persistent connection
+to carbon, using the plaintext (port 2003) or the pickle protocol (port 2004).
+While carbon is unreachable the points are kept in memory, up to --max-buffer
+points, and sent once the connection is restored.
+
+Metrics, under --prefix (ngserver.<short hostname> by default). {jvm} in the
+prefix is replaced by the name of the jar or of the main class, {pid} by the pid.
+Without them only the oldest matching JVM is monitored.
+
+    memory.<eden,survivor0,survivor1,old,perm,metaspace,compressed_class,heap>.<capacity_bytes,used_bytes>
+    gc.<young,full,concurrent,total>.<count,time_seconds>
+    threads.<live,daemon,peak,started>
+    classes.<loaded,unloaded,shared_loaded,load_time_seconds>
+    safepoints.<count,time_seconds>
+    heap.total.<objects,object_size_bytes,classes>                      (histogram job)
+    heap.classes.<class>.<instances,bytes>
+    heap.growth.<class>.bytes
+    heap.total.<live_objects,live_objects_size_bytes,live_classes>      (live histogram job)
+    heap.live_classes.<class>.<instances,bytes>
+    heap.live_growth.<class>.bytes
+
+Usage:
+
+    jvm_to_graphite.py --match 'myserver.*\\.jar' --protocol pickle --carbon-host graphite.example.com
+    jvm_to_graphite.py --match . --prefix 'servers.myhost.jvm.{jvm}' --interval 1
+    jvm_to_graphite.py --top-classes 20 --top-growers 10 --live-histo-interval 0
+"""
+
+import collections
+import logging
+import heapq
+import optparse
+import os
+import pickle
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import hsperfdata
+
+log = logging.getLogger('jvm_to_graphite')
+
+
+# Persistent connection to carbon. Points are buffered until they are sent,
+# the oldest points are dropped beyond max_buffer.
+class CarbonClient(object):
+
+    def __init__(self, host, port, protocol='plaintext', timeout=15, max_buffer=10000,
+                 batch_size=500, max_backoff=60):
+        self.address = (host, port)
+        self.protocol = protocol
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.sock = None
+        self.backoff = 0
+        self.retry_at = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    # Queue (path, value, timestamp) points and try to send everything buffered
+    def send(self, points):
+        self.lock.acquire()
+        try:
+            overflow = len(self.buffer) + len(points) - self.buffer.maxlen
+            if overflow > 0:
+                self.dropped = self.dropped + overflow
+                log.warning('carbon buffer full, dropping the %d oldest points', overflow)
+            self.buffer.extend(points)
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        while self.buffer:
+            if self.sock is None and not self._connect():
+                return
+            batch = [self.buffer[i] for i in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                self.sock.sendall(self.encode(batch))
+            except socket.error as e:
+                log.warning('could not send %d points to carbon %s:%d: %s', len(batch),
+                            self.address[0], self.address[1], e)
+                self.close()
+                self._schedule_retry()
+                return
+            for i in range(len(batch)):
+                self.buffer.popleft()
+
+    def encode(self, points):
+        if self.protocol == 'pickle':
+            payload = pickle.dumps([(path, (timestamp, value)) for path, value, timestamp in points], 2)
+            return struct.pack('!L', len(payload)) + payload
+        lines = ['%s %s %d\n' % (path, value, timestamp) for path, value, timestamp in points]
+        return ''.join(lines).encode('ascii')
+
+    def _connect(self):
+        if time.time() < self.retry_at:
+            return False
+        try:
+            self.sock = socket.create_connection(self.address, self.timeout)
+        except socket.error as e:
+            log.warning('could not connect to carbon %s:%d: %s', self.address[0], self.address[1], e)
+            self.sock = None
+            self._schedule_retry()
+            return False
+        log.info('connected to carbon %s:%d', self.address[0], self.address[1])
+        self.backoff = 0
+        return True
+
+    def _schedule_retry(self):
+        self.backoff = min(max(self.backoff * 2, 1), self.max_backoff)
+        self.retry_at = time.time() + self.backoff
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+# Locates the JDK tools, in --jdk-bin if given, otherwise in the PATH
+class JDK(object):
+
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir
+
+    # Yield the output of the tool line by line, as it is produced
+    def lines(self, tool, *args):
+        if self.bin_dir:
+            tool = os.path.join(self.bin_dir, tool)
+        process = subprocess.Popen((tool,) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            process.stdout.close()
+            err = process.stderr.read()
+            process.stderr.close()
+            if process.wait() != 0:
+                raise RuntimeError('%s %s failed: %s' % (tool, ' '.join(args), err.strip()))
+
+
+# hsperfdata counters: (counter, metric, in ticks). Sizes are in bytes, times
+# in ticks of sun.os.hrt.frequency. Counters missing in a JVM are skipped, the
+# spaces depend on the garbage collector and on the Java version.
+COUNTERS = (
+    ('sun.gc.generation.0.space.0.capacity', 'memory.eden.capacity_bytes', False),
+    ('sun.gc.generation.0.space.0.used', 'memory.eden.used_bytes', False),
+    ('sun.gc.generation.0.space.1.capacity', 'memory.survivor0.capacity_bytes', False),
+    ('sun.gc.generation.0.space.1.used', 'memory.survivor0.used_bytes', False),
+    ('sun.gc.generation.0.space.2.capacity', 'memory.survivor1.capacity_bytes', False),
+    ('sun.gc.generation.0.space.2.used', 'memory.survivor1.used_bytes', False),
+    ('sun.gc.generation.1.space.0.capacity', 'memory.old.capacity_bytes', False),
+    ('sun.gc.generation.1.space.0.used', 'memory.old.used_bytes', False),
+    ('sun.gc.generation.2.space.0.capacity', 'memory.perm.capacity_bytes', False),
+    ('sun.gc.generation.2.space.0.used', 'memory.perm.used_bytes', False),
+    ('sun.gc.metaspace.capacity', 'memory.metaspace.capacity_bytes', False),
+    ('sun.gc.metaspace.used', 'memory.metaspace.used_bytes', False),
+    ('sun.gc.compressedclassspace.capacity', 'memory.compressed_class.capacity_bytes', False),
+    ('sun.gc.compressedclassspace.used', 'memory.compressed_class.used_bytes', False),
+    ('sun.gc.collector.0.invocations', 'gc.young.count', False),
+    ('sun.gc.collector.0.time', 'gc.young.time_seconds', True),
+    ('sun.gc.collector.1.invocations', 'gc.full.count', False),
+    ('sun.gc.collector.1.time', 'gc.full.time_seconds', True),
+    ('sun.gc.collector.2.invocations', 'gc.concurrent.count', False),
+    ('sun.gc.collector.2.time', 'gc.concurrent.time_seconds', True),
+    ('java.threads.live', 'threads.live', False),
+    ('java.threads.daemon', 'threads.daemon', False),
+    ('java.threads.livePeak', 'threads.peak', False),
+    ('java.threads.started', 'threads.started', False),
+    ('java.cls.loadedClasses', 'classes.loaded', False),
+    ('java.cls.unloadedClasses', 'classes.unloaded', False),
+    ('java.cls.sharedLoadedClasses', 'classes.shared_loaded', False),
+    ('sun.cls.time', 'classes.load_time_seconds', True),
+    ('sun.rt.safepoints', 'safepoints.count', False),
+    ('sun.rt.safepointTime', 'safepoints.time_seconds', True),
+)
+
+HEAP_SPACES = ('eden', 'survivor0', 'survivor1', 'old')
+GC_TIMES = ('gc.young.time_seconds', 'gc.full.time_seconds', 'gc.concurrent.time_seconds')
+
+
+# Metric name of a JVM: the jar without .jar, or the simple name of the main class
+def jvm_name(command):
+    parts = command.split()
+    if not parts:
+        return 'unknown'
+    if parts[0].endswith('.jar'):
+        name = os.path.basename(parts[0])[:-len('.jar')]
+    else:
+        name = parts[0].split('.')[-1]
+    return re.sub('[^A-Za-z0-9_-]', '_', name)
+
+
+# A monitored JVM and the reader of its counters
+class JVM(object):
+
+    def __init__(self, pid, path):
+        self.pid = pid
+        self.perfdata = hsperfdata.PerfData(path)
+        if not self.perfdata.accessible():
+            self.close()
+            raise ValueError('counters of JVM %d not initialized yet' % pid)
+        self.command = ''
+        if 'sun.rt.javaCommand' in self.perfdata.strings:
+            self.command = self.perfdata.string('sun.rt.javaCommand')
+        self.name = jvm_name(self.command)
+        self.prefix = None
+        # live: ClassHistogram, used by the histogram jobs
+        self.histograms = {}
+        self.compile()
+
+    def compile(self):
+        perfdata = self.perfdata
+        self.reader = perfdata.reader([counter for counter, metric, ticks in COUNTERS])
+        located = {}
+        for counter, metric, ticks in COUNTERS:
+            located[counter] = (metric, ticks)
+        self.metrics = tuple([located[counter] for counter in self.reader.names])
+        self.frequency = 1e9
+        if 'sun.os.hrt.frequency' in perfdata.counters:
+            self.frequency = float(perfdata.long('sun.os.hrt.frequency'))
+
+    # Return {metric: value}
+    def read(self):
+        if self.perfdata.refresh():
+            self.compile()
+        metrics = {}
+        for (metric, ticks), value in zip(self.metrics, self.reader.read()):
+            if ticks:
+                value = value / self.frequency
+            metrics[metric] = value
+
+        for unit in ('capacity_bytes', 'used_bytes'):
+            names = ['memory.%s.%s' % (space, unit) for space in HEAP_SPACES]
+            if all([name in metrics for name in names]):
+                metrics['memory.heap.' + unit] = sum([metrics[name] for name in names])
+        times = [metrics[name] for name in GC_TIMES if name in metrics]
+        if times:
+            metrics['gc.total.time_seconds'] = sum(times)
+        return metrics
+
+    def close(self):
+        self.perfdata.close()
+
+
+PRIMITIVE_ARRAYS = {'B': 'byte', 'C': 'char', 'D': 'double', 'F': 'float', 'I': 'int', 'J': 'long',
+                    'S': 'short', 'Z': 'boolean'}
+INVALID_METRIC = re.compile('[^A-Za-z0-9_-]')
+
+
+# Metric name of a class of jmap -histo: java.lang.String -> java_lang_String,
+# [Ljava.lang.Object; -> java_lang_Object_array, [[I -> int_array_array
+def class_metric_name(name):
+    # Java 9 and later add the module: java.lang.String (java.base@11.0.2)
+    name = name.split(' ', 1)[0]
+    # the address of hidden classes and lambdas changes at every run: Main$$Lambda$14/0x0000000800066840
+    name = name.split('/', 1)[0]
+    dimensions = len(name) - len(name.lstrip('['))
+    if dimensions:
+        name = name[dimensions:]
+        if name.startswith('L') and name.endswith(';'):
+            name = name[1:-1]
+        else:
+            name = PRIMITIVE_ARRAYS.get(name, name)
+        name = name + '_array' * dimensions
+    return INVALID_METRIC.sub('_', name.replace('.', '_')).strip('_')
+
+
+# Keep the n largest (value, entry) in a heap
+def push_largest(heap, n, value, entry):
+    if len(heap) < n:
+        heapq.heappush(heap, (value, entry))
+    else:
+        heapq.heapreplace(heap, (value, entry))
+
+
+# Parses the class histograms of a JVM in a single pass over the output of
+# jmap -histo, as it is streamed. The bytes of the max_classes largest classes
+# are kept until the next histogram to find the classes that grow the most: a
+# class that was not among them has no growth until the next histogram.
+class ClassHistogram(object):
+
+    def __init__(self, top, growers, max_classes):
+        self.top = top
+        self.growers = growers
+        self.max_classes = max_classes
+        self.previous = {}
+
+    # Return (instances, bytes, classes, [(class, instances, bytes)] of the
+    # top classes by bytes and by instances, [(class, growth in bytes)])
+    def parse(self, lines):
+        top = self.top
+        growers = self.growers
+        max_classes = self.max_classes
+        previous = self.previous
+        by_bytes = []
+        by_instances = []
+        largest = []
+        growth = []
+        classes = 0
+        total = None
+        for line in lines:
+            # "   1:        100        2000  [B" or "Total        1234      567890"
+            parts = line.split(None, 3)
+            if len(parts) == 4 and parts[0][-1:] == ':':
+                instances = int(parts[1])
+                size = int(parts[2])
+                name = parts[3].rstrip()
+                classes = classes + 1
+                # the tuples are only allocated for the classes that enter a heap
+                if len(by_bytes) < top or (top and size > by_bytes[0][0]):
+                    push_largest(by_bytes, top, size, (name, instances, size))
+                if len(by_instances) < top or (top and instances > by_instances[0][0]):
+                    push_largest(by_instances, top, instances, (name, instances, size))
+                if len(largest) < max_classes or (max_classes and size > largest[0][0]):
+                    push_largest(largest, max_classes, size, name)
+                if growers and size > previous.get(name, size):
+                    delta = size - previous[name]
+                    if len(growth) < growers or delta > growth[0][0]:
+                        push_largest(growth, growers, delta, name)
+            elif len(parts) == 3 and parts[0] == 'Total':
+                total = int(parts[1]), int(parts[2])
+        if total is None:
+            raise ValueError('no Total line in the histogram')
+
+        self.previous = dict([(name, size) for size, name in largest])
+        winners = {}
+        for value, entry in by_bytes + by_instances:
+            winners[entry[0]] = entry
+        growth.sort(reverse=True)
+        return total[0], total[1], classes, list(winners.values()), [(name, delta) for delta, name in growth]
+
+
+# A job executed every `interval` seconds by its own thread, so that a slow
+# histogram does not delay the ticks
+class PeriodicJob(threading.Thread):
+
+    def __init__(self, name, interval, func, stopping):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.interval = interval
+        self.func = func
+        self.stopping = stopping
+
+    def run(self):
+        while not self.stopping.is_set():
+            start = time.time()
+            try:
+                self.func()
+            except Exception as e:
+                log.error('%s failed: %s', self.name, e)
+            self.stopping.wait(max(self.interval - (time.time() - start), 0))
+
+
+class JVMToGraphite(object):
+
+    def __init__(self, options, carbon, jdk):
+        self.options = options
+        self.carbon = carbon
+        self.jdk = jdk
+        self.stopping = threading.Event()
+        # pid: JVM of the JVMs matching --match
+        self.jvms = {}
+        # pids of the JVMs not matching --match
+        self.ignored = set()
+        # (pid, prefix, JVM) of the monitored JVMs, replaced as a whole for the histogram jobs
+        self.monitored = ()
+
+    # Attach to the new JVMs and detach from the ones that exited
+    def discover(self):
+        changed = False
+        pids = set()
+        for pid, path in hsperfdata.find_jvms(self.options.hsperfdata_dir):
+            pids.add(pid)
+            if pid in self.jvms or pid in self.ignored:
+                continue
+            try:
+                jvm = JVM(pid, path)
+            except (EnvironmentError, ValueError) as e:
+                # not initialized yet or not readable, retried at the next tick
+                log.debug('cannot read the counters of JVM %d: %s', pid, e)
+                continue
+            if not re.search(self.options.match, jvm.command):
+                jvm.close()
+                self.ignored.add(pid)
+                continue
+            log.info('monitoring JVM %d: %s', pid, jvm.command)
+            self.jvms[pid] = jvm
+            changed = True
+
+        for pid in list(self.jvms):
+            if pid not in pids:
+                log.info('JVM %d exited', pid)
+                self.jvms.pop(pid).close()
+                changed = True
+        self.ignored = self.ignored & pids
+        if changed:
+            self.assign_prefixes()
+
+    # Without {jvm} or {pid} in --prefix only one JVM can be monitored: the oldest one
+    def assign_prefixes(self):
+        template = self.options.prefix
+        per_jvm = '{jvm}' in template or '{pid}' in template
+        names = {}
+        for jvm in self.jvms.values():
+            names[jvm.name] = names.get(jvm.name, 0) + 1
+        monitored = []
+        for pid in sorted(self.jvms):
+            jvm = self.jvms[pid]
+            jvm.prefix = None
+            if not per_jvm and monitored:
+                log.warning('ignoring JVM %d: add {jvm} or {pid} to --prefix to monitor several JVMs', pid)
+                continue
+            name = jvm.name
+            if names[name] > 1:
+                name = '%s_%d' % (name, pid)
+            jvm.prefix = template.replace('{jvm}', name).replace('{pid}', str(pid))
+            monitored.append((pid, jvm.prefix, jvm))
+        self.monitored = tuple(monitored)
+
+    def points(self, prefix, metrics, timestamp):
+        return [('%s.%s' % (prefix, name), value, timestamp) for name, value in sorted(metrics.items())]
+
+    # Cheap metrics, every interval
+    def tick(self):
+        self.discover()
+        timestamp = int(time.time())
+        points = []
+        for pid, prefix, jvm in self.monitored:
+            try:
+                points.extend(self.points(prefix, jvm.read(), timestamp))
+            except (ValueError, struct.error) as e:
+                log.error('cannot read the counters of JVM %d: %s', pid, e)
+        if points:
+            self.carbon.send(points)
+
+    def histogram(self, live=False):
+        options = self.options
+        for pid, prefix, jvm in self.monitored:
+            if live not in jvm.histograms:
+                jvm.histograms[live] = ClassHistogram(options.top_classes, options.top_growers, options.max_classes)
+            timestamp = int(time.time())
+            if live:
+                lines = self.jdk.lines('jmap', '-histo:live', str(pid))
+                names = ('heap.total.live_objects', 'heap.total.live_objects_size_bytes',
+                         'heap.total.live_classes', 'heap.live_classes', 'heap.live_growth')
+            else:
+                lines = self.jdk.lines('jmap', '-histo', str(pid))
+                names = ('heap.total.objects', 'heap.total.object_size_bytes',
+                         'heap.total.classes', 'heap.classes', 'heap.growth')
+            objects, size, classes, top, growth = jvm.histograms[live].parse(lines)
+
+            metrics = {names[0]: objects, names[1]: size, names[2]: classes}
+            # distinct classes can have the same metric name
+            for name, instances, class_bytes in top:
+                name = class_metric_name(name)
+                for metric, value in (('instances', instances), ('bytes', class_bytes)):
+                    path = '%s.%s.%s' % (names[3], name, metric)
+                    metrics[path] = metrics.get(path, 0) + value
+            for name, delta in growth:
+                path = '%s.%s.bytes' % (names[4], class_metric_name(name))
+                metrics[path] = metrics.get(path, 0) + delta
+            self.carbon.send(self.points(prefix, metrics, timestamp))
+
+    def run(self):
+        jobs = []
+        if self.options.histo_interval > 0:
+            jobs.append(PeriodicJob('histogram', self.options.histo_interval, self.histogram, self.stopping))
+        if self.options.live_histo_interval > 0:
+            jobs.append(PeriodicJob('live-histogram', self.options.live_histo_interval,
+                                    lambda: self.histogram(live=True), self.stopping))
+        for job in jobs:
+            job.start()
+
+        interval = self.options.interval
+        next_tick = time.time()
+        while not self.stopping.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                log.error('tick failed: %s', e)
+            next_tick = next_tick + interval
+            now = time.time()
+            if next_tick < now:
+                # skip the ticks that were missed
+                next_tick = now + interval - (now - next_tick) % interval
+            self.stopping.wait(next_tick - now)
+        self.carbon.close()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--carbon-host', default='127.0.0.1', help='carbon host [%default]')
+    parser.add_option('--carbon-port', type='int', help='carbon port [2003, 2004 with pickle]')
+    parser.add_option('--protocol', choices=('plaintext', 'pickle'), default='plaintext',
+                      help='carbon protocol: plaintext or pickle [%default]')
+    parser.add_option('--prefix', default='ngserver.' + socket.gethostname().split('.')[0],
+                      help='metric path prefix, {jvm} and {pid} are replaced by the name and the pid ' +
+                      'of each JVM [%default]')
+    parser.add_option('--match', default='jar', help='regular expression matching the command line ' +
+                      '(main class or jar and arguments) of the JVMs to monitor [%default]')
+    parser.add_option('--hsperfdata-dir', default='/tmp',
+                      help='directory of the hsperfdata_<user> directories [%default]')
+    parser.add_option('--interval', type='float', default=10, help='seconds between ticks [%default]')
+    parser.add_option('--histo-interval', type='float', default=600,
+                      help='seconds between class histograms, 0 to disable [%default]')
+    parser.add_option('--live-histo-interval', type='float', default=3600,
+                      help='seconds between live class histograms, which force a full GC, ' +
+                      '0 to disable [%default]')
+    parser.add_option('--top-classes', type='int', default=0,
+                      help='classes of each histogram published by bytes and by instances [%default]')
+    parser.add_option('--top-growers', type='int', default=0,
+                      help='classes of each histogram published by growth since the previous one [%default]')
+    parser.add_option('--max-classes', type='int', default=5000,
+                      help='largest classes of each histogram kept to compute the growth [%default]')
+    parser.add_option('--max-buffer', type='int', default=10000,
+                      help='points kept in memory while carbon is unreachable [%default]')
+    parser.add_option('--batch-size', type='int', default=500, help='points per message [%default]')
+    parser.add_option('--jdk-bin', help='directory of jmap [PATH]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    if options.carbon_port is None:
+        options.carbon_port = options.protocol == 'pickle' and 2004 or 2003
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(levelname)s %(threadName)s: %(message)s')
+    carbon = CarbonClient(options.carbon_host, options.carbon_port, options.protocol,
+                          max_buffer=options.max_buffer, batch_size=options.batch_size)
+    daemon = JVMToGraphite(options, carbon, JDK(options.jdk_bin))
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
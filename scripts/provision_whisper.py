@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Creates the whisper files of the series a collector is about to publish, before
+carbon receives them, and removes the files of the series that disappeared.
+
+A new MySQL host or schema makes MySQLSizeCollector and MySQLPerfSchemaCollector
+publish thousands of new series at once (size.<schema>.<table>.*,
+index.*.<schema>.<table>.<index>, ...). carbon creates at most
+MAX_CREATES_PER_MINUTE files per minute and drops or delays the points of the
+other new series in the meantime. Creating the files in advance avoids it.
+
+The expected series are either:
+
+ * captured from a dry run of a collector: the collector runs --cycles times against
+   its hosts and the paths it publishes are recorded instead of being sent, or
+ * read from a list of metrics, one per line, e.g., the archive log of
+   Diamond's ArchiveHandler or a capture of the plaintext protocol. Only the
+   first field of each line is used.
+
+The missing files are created under --data-dir (LOCAL_DATA_DIR of carbon.conf)
+by --workers threads, at most --rate files per minute, with the retentions of
+the first matching section of storage-schemas.conf and the aggregation of
+storage-aggregation.conf, like carbon would.
+
+With --prune-prefix, the files under the given metric prefixes that are not
+expected and were not updated for --prune-min-age seconds are deleted, e.g.,
+the series of dropped tables. Files still updated by carbon are never deleted.
+
+Requires the whisper module of Graphite. Diamond, configobj and MySQLdb are
+also required for a dry run.
+
+Usage:
+
+    # series of a captured list of metrics
+    provision_whisper.py --metrics metrics.txt
+    # dry run of the collector configured in MySQLSizeCollector.conf, then prune the dropped tables
+    provision_whisper.py --collector mysqldbsizes.MySQLSizeCollector \\
+        --collector-config /etc/diamond/collectors/MySQLSizeCollector.conf \\
+        --prune-prefix mysql.db1 --dry-run
+"""
+
+import logging
+import optparse
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    import whisper
+except ImportError:
+    whisper = None
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger('provision_whisper')
+
+
+# Return [(section, {key: value})] of an ini file, in the order of the file.
+# Carbon uses the first matching section, which ConfigParser does not preserve
+# on old Pythons.
+def read_sections(path):
+    sections = []
+    f = open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                sections.append((line[1:-1].strip(), {}))
+            elif '=' in line and sections:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    finally:
+        f.close()
+    return sections
+
+
+# Whisper archives and aggregation of a metric, resolved like carbon does
+class Storage(object):
+
+    def __init__(self, schemas_path, aggregation_path=None):
+        # [(name, pattern, archives)]
+        self.schemas = []
+        for name, options in read_sections(schemas_path):
+            if 'pattern' not in options or 'retentions' not in options:
+                continue
+            archives = [whisper.parseRetentionDef(retention.strip())
+                        for retention in options['retentions'].split(',')]
+            whisper.validateArchiveList(archives)
+            self.schemas.append((name, re.compile(options['pattern']), archives))
+        # [(pattern, xFilesFactor, aggregationMethod)]
+        self.aggregations = []
+        if aggregation_path and os.path.exists(aggregation_path):
+            for name, options in read_sections(aggregation_path):
+                if 'pattern' not in options:
+                    continue
+                x_files_factor = options.get('xFilesFactor')
+                if x_files_factor is not None:
+                    x_files_factor = float(x_files_factor)
+                self.aggregations.append((re.compile(options['pattern']), x_files_factor,
+                                          options.get('aggregationMethod')))
+
+    # Return (archives, xFilesFactor, aggregationMethod), None if no schema matches
+    def lookup(self, metric):
+        for name, pattern, archives in self.schemas:
+            if pattern.search(metric):
+                break
+        else:
+            return None
+        for pattern, x_files_factor, method in self.aggregations:
+            if pattern.search(metric):
+                return archives, x_files_factor, method
+        return archives, None, None
+
+
+# Return the set of metrics of a list, one per line
+def read_metrics(f):
+    metrics = set()
+    for line in f:
+        parts = line.split()
+        if parts and not parts[0].startswith('#'):
+            metrics.add(parts[0])
+    return metrics
+
+
+# Run a Diamond collector for some cycles and return the set of the paths it publishes
+def dry_run(collector_name, collectors_path, config_path, hostname, cycles, interval):
+    import configobj
+
+    for path in collectors_path:
+        sys.path.insert(0, path)
+        # each collector lives in a directory named after its module
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path, name)):
+                    sys.path.insert(0, os.path.join(path, name))
+    module_name, class_name = collector_name.rsplit('.', 1)
+    module = __import__(module_name)
+    cls = getattr(module, class_name)
+
+    # a collector configuration file (/etc/diamond/collectors/<name>.conf) holds
+    # the options of the collector, diamond.conf holds them in [collectors]
+    config = configobj.ConfigObj()
+    if config_path:
+        config.merge(configobj.ConfigObj(config_path))
+    if 'collectors' not in config:
+        config = configobj.ConfigObj({'collectors': {cls.__name__: config}})
+    section = config['collectors'].setdefault(cls.__name__, {})
+    # nothing is sent nor saved by a dry run
+    section['counter_state_file'] = ''
+    if hostname:
+        section['hostname'] = hostname
+
+    collector = cls(config=config, handlers=[])
+    paths = set()
+
+    # Diamond builds the path and applies the whitelist and the blacklist before
+    # handing the metric to the handlers
+    def publish_metric(metric):
+        paths.add(metric.path)
+
+    collector.publish_metric = publish_metric
+    # the rates are only published from the second cycle
+    for cycle in range(cycles):
+        if cycle:
+            time.sleep(interval)
+        collector.collect()
+    return paths
+
+
+def metric_file(data_dir, metric):
+    return os.path.join(data_dir, *metric.split('.')) + '.wsp'
+
+
+# Hands out creation slots spaced by 60 / rate seconds to the worker threads
+class RateLimiter(object):
+
+    def __init__(self, per_minute):
+        self.spacing = 60.0 / per_minute
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.spacing
+        finally:
+            self.lock.release()
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Provisioner(object):
+
+    def __init__(self, options, storage):
+        self.options = options
+        self.storage = storage
+        self.limiter = RateLimiter(options.rate)
+        self.lock = threading.Lock()
+        self.counts = {'expected': 0, 'existing': 0, 'created': 0, 'unmatched': 0, 'failed': 0, 'pruned': 0}
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.counts[name] = self.counts[name] + 1
+        finally:
+            self.lock.release()
+
+    # Return [(metric, path, storage)] of the missing files
+    def plan(self, metrics):
+        missing = []
+        for metric in sorted(metrics):
+            self.counts['expected'] = self.counts['expected'] + 1
+            path = metric_file(self.options.data_dir, metric)
+            if os.path.exists(path):
+                self.counts['existing'] = self.counts['existing'] + 1
+                continue
+            storage = self.storage.lookup(metric)
+            if storage is None:
+                log.warning('no storage schema matches %s, skipping it', metric)
+                self.counts['unmatched'] = self.counts['unmatched'] + 1
+                continue
+            missing.append((metric, path, storage))
+        return missing
+
+    def create(self, missing):
+        if self.options.dry_run:
+            for metric, path, storage in missing:
+                log.info('would create %s %s', path, storage[0])
+            return
+        work = queue.Queue()
+        for item in missing:
+            work.put(item)
+        threads = []
+        for i in range(min(self.options.workers, len(missing))):
+            thread = threading.Thread(target=self._worker, args=(work,), name='create-%d' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, work):
+        while True:
+            try:
+                metric, path, (archives, x_files_factor, method) = work.get_nowait()
+            except queue.Empty:
+                return
+            self.limiter.wait()
+            try:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError:
+                        # created by another worker
+                        if not os.path.isdir(directory):
+                            raise
+                whisper.create(path, archives, x_files_factor, method, self.options.sparse)
+                log.debug('created %s', path)
+                self.count('created')
+            except whisper.InvalidConfiguration:
+                # created by carbon in the meantime
+                self.count('existing')
+            except (EnvironmentError, whisper.WhisperException) as e:
+                log.error('could not create %s: %s', path, e)
+                self.count('failed')
+
+    # Delete the files under the prefixes that are not expected and not updated recently
+    def prune(self, metrics, prefixes):
+        expected = set([metric_file(self.options.data_dir, metric) for metric in metrics])
+        oldest = time.time() - self.options.prune_min_age
+        for prefix in prefixes:
+            root = os.path.join(self.options.data_dir, *prefix.split('.'))
+            for directory, dirs, files in os.walk(root, topdown=False):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    if not name.endswith('.wsp') or path in expected:
+                        continue
+                    try:
+                        if os.path.getmtime(path) > oldest:
+                            continue
+                        if self.options.dry_run:
+                            log.info('would delete %s', path)
+                        else:
+                            os.remove(path)
+                            log.debug('deleted %s', path)
+                        self.count('pruned')
+                    except OSError as e:
+                        log.error('could not delete %s: %s', path, e)
+                if not self.options.dry_run and directory != root:
+                    try:
+                        # only succeeds if empty
+                        os.rmdir(directory)
+                    except OSError:
+                        pass
+
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage='%prog (--metrics FILE | --collector MODULE.CLASS) [options]')
+    parser.add_option('--metrics', help='file listing the metrics, one per line, - for stdin')
+    parser.add_option('--collector', help='collector to dry run, e.g., mysqlperfschema.MySQLPerfSchemaCollector')
+    parser.add_option('--collector-config', help='configuration file of the collector, e.g., ' +
+                      '/etc/diamond/collectors/MySQLPerfSchemaCollector.conf, or diamond.conf')
+    parser.add_option('--collectors-path', action='append',
+                      help='directory of the collectors, may be repeated [/usr/share/diamond/collectors]')
+    parser.add_option('--cycles', type='int', default=2, help='collections of the dry run [%default]')
+    parser.add_option('--cycle-interval', type='float', default=5,
+                      help='seconds between the collections of the dry run [%default]')
+    parser.add_option('--hostname', help='hostname of the metric paths of the dry run [the hostname of Diamond]')
+    parser.add_option('--data-dir', default='/var/lib/graphite/whisper',
+                      help='LOCAL_DATA_DIR of carbon [%default]')
+    parser.add_option('--schemas', default='/etc/carbon/storage-schemas.conf', help='[%default]')
+    parser.add_option('--aggregation', default='/etc/carbon/storage-aggregation.conf', help='[%default]')
+    parser.add_option('--rate', type='float', default=1200, help='maximum files created per minute [%default]')
+    parser.add_option('--workers', type='int', default=4, help='threads creating the files [%default]')
+    parser.add_option('--sparse', action='store_true', default=False,
+                      help='create sparse files, faster but fragmented')
+    parser.add_option('--prune-prefix', action='append', default=[],
+                      help='delete the files under this metric prefix that are not expected, may be repeated')
+    parser.add_option('--prune-min-age', type='float', default=86400,
+                      help='only delete the files not updated for this number of seconds [%default]')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help='only print the files that would be created or deleted')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    if (options.metrics is None) == (options.collector is None):
+        parser.error('one of --metrics and --collector is required')
+    if whisper is None:
+        parser.error('the whisper module is required')
+    if options.rate <= 0 or options.workers <= 0:
+        parser.error('--rate and --workers must be positive')
+    if not options.collectors_path:
+        options.collectors_path = ['/usr/share/diamond/collectors']
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if options.metrics == '-':
+        metrics = read_metrics(sys.stdin)
+    elif options.metrics:
+        f = open(options.metrics)
+        try:
+            metrics = read_metrics(f)
+        finally:
+            f.close()
+    else:
+        metrics = dry_run(options.collector, options.collectors_path, options.collector_config, options.hostname,
+                          options.cycles, options.cycle_interval)
+
+    provisioner = Provisioner(options, Storage(options.schemas, options.aggregation))
+    start = time.time()
+    provisioner.create(provisioner.plan(metrics))
+    if options.prune_prefix:
+        provisioner.prune(metrics, options.prune_prefix)
+    counts = provisioner.counts
+    log.info('%d expected series: %d existing, %d created, %d without schema, %d failed, %d pruned in %.1fs',
+             counts['expected'], counts['existing'], counts['created'], counts['unmatched'], counts['failed'],
+             counts['pruned'], time.time() - start)
+    return counts['failed'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
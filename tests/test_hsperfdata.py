@@ -0,0 +1,160 @@
+# coding=utf-8
+
+"""
+Tests of hsperfdata.py against hsperfdata files generated in a temporary
+directory, in the version 2 format written by HotSpot, in both byte orders.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import hsperfdata
+
+FILE_SIZE = 32768
+
+
+# Return an entry of the counter or string value, padded to 8 bytes as the JVM does
+def entry(name, value, order):
+    name = name.encode('ascii') + b'\x00'
+    if isinstance(value, int):
+        data_type, vector_length, data = b'J', 0, struct.pack(order + 'q', value)
+    else:
+        data = value.encode('utf-8')
+        # the JVM reserves room for longer values, the string is NUL terminated
+        data_type, vector_length, data = b'B', len(data) + 8, data + b'\x00' * 8
+    name_offset = 20
+    data_offset = name_offset + len(name)
+    data_offset = data_offset + (-data_offset) % 8
+    length = data_offset + len(data)
+    length = length + (-length) % 8
+    header = struct.pack(order + 'iiiBBBBi', length, name_offset, vector_length, ord(data_type), 0, 0, 0,
+                         data_offset)
+    body = header + name + b'\x00' * (data_offset - name_offset - len(name)) + data
+    return body + b'\x00' * (length - len(body))
+
+
+# Return the content of an hsperfdata file holding the (name, value) counters
+def perfdata(counters, order='<', major=2, accessible=1, magic=hsperfdata.MAGIC):
+    entries = b''.join([entry(name, value, order) for name, value in counters])
+    prologue = struct.pack('>I', magic) + struct.pack(order + 'BBBBiiqii', order == '<' and 1 or 0, major, 0,
+                                                      accessible, 32 + len(entries), 0, 0, 32, len(counters))
+    data = prologue + entries
+    return data + b'\x00' * (FILE_SIZE - len(data))
+
+
+COUNTERS = [
+    ('sun.os.hrt.frequency', 1000000000),
+    ('sun.rt.javaCommand', 'org.example.Main --port 8080'),
+    ('sun.gc.generation.0.space.0.used', 64 << 20),
+    ('java.threads.live', 42),
+    ('sun.gc.collector.0.invocations', 12),
+    ('sun.gc.collector.0.time', -1),
+]
+
+
+ORDERS = {'<': 'little', '>': 'big'}
+
+
+class PerfDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.opened = []
+
+    def tearDown(self):
+        for data in self.opened:
+            data.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, content, name='hsperfdata_app', pid=None):
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        path = os.path.join(directory, str(pid or os.getpid()))
+        f = open(path, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return path
+
+    def open(self, path):
+        data = hsperfdata.PerfData(path)
+        self.opened.append(data)
+        return data
+
+    def test_find_jvms(self):
+        path = self.write(perfdata(COUNTERS))
+        # not a pid, and the file of a JVM that is gone
+        self.write(b'', pid='notapid')
+        self.write(b'', name='hsperfdata_other', pid=2 ** 22 + 1)
+        os.mkdir(os.path.join(self.directory, 'other'))
+        self.assertEqual(hsperfdata.find_jvms(self.directory), [(os.getpid(), path)])
+        self.assertEqual(hsperfdata.find_jvms(os.path.join(self.directory, 'missing')), [])
+
+    def test_parses_both_byte_orders(self):
+        for order in ('<', '>'):
+            data = self.open(self.write(perfdata(COUNTERS, order), name='hsperfdata_' + ORDERS[order]))
+            self.assertEqual(data.order, order)
+            self.assertTrue(data.accessible())
+            self.assertEqual(data.entries, len(COUNTERS))
+            self.assertEqual(sorted(data.counters.keys()),
+                             sorted([name for name, value in COUNTERS if isinstance(value, int)]))
+            self.assertEqual(data.long('sun.os.hrt.frequency'), 1000000000)
+            self.assertEqual(data.long('sun.gc.generation.0.space.0.used'), 64 << 20)
+            self.assertEqual(data.long('sun.gc.collector.0.time'), -1)
+            self.assertEqual(data.string('sun.rt.javaCommand'), u'org.example.Main --port 8080')
+
+    def test_not_accessible_yet(self):
+        data = self.open(self.write(perfdata(COUNTERS, accessible=0)))
+        self.assertFalse(data.accessible())
+
+    def test_rejects_other_files(self):
+        self.assertRaises(ValueError, hsperfdata.PerfData, self.write(perfdata(COUNTERS, magic=0xdeadbeef)))
+        self.assertRaises(ValueError, hsperfdata.PerfData, self.write(perfdata(COUNTERS, major=1)))
+
+    def test_refresh_indexes_the_new_counters(self):
+        path = self.write(perfdata(COUNTERS))
+        data = self.open(path)
+        self.assertFalse(data.refresh())
+
+        # the JVM updates the mapped file in place
+        f = open(path, 'r+b')
+        try:
+            f.write(perfdata(COUNTERS + [('java.cls.loadedClasses', 8000)]))
+        finally:
+            f.close()
+        self.assertTrue(data.refresh())
+        self.assertEqual(data.long('java.cls.loadedClasses'), 8000)
+        self.assertFalse(data.refresh())
+
+    def test_reader_skips_the_bytes_between_the_counters(self):
+        for order in ('<', '>'):
+            data = self.open(self.write(perfdata(COUNTERS, order), name='hsperfdata_' + ORDERS[order]))
+            names = ['sun.gc.collector.0.invocations', 'missing', 'sun.os.hrt.frequency', 'java.threads.live']
+            reader = data.reader(names)
+            # sorted by offset, missing counters left out
+            self.assertEqual(reader.names, ('sun.os.hrt.frequency', 'java.threads.live',
+                                            'sun.gc.collector.0.invocations'))
+            self.assertEqual(reader.base, data.counters['sun.os.hrt.frequency'])
+            # the entries in between are padding
+            self.assertTrue('x' in str(reader.struct.format))
+            self.assertEqual(reader.struct.size,
+                             data.counters['sun.gc.collector.0.invocations'] + 8 - reader.base)
+            self.assertEqual(reader.read(), (1000000000, 42, 12))
+
+    def test_reader_without_counters(self):
+        data = self.open(self.write(perfdata(COUNTERS)))
+        reader = data.reader(['missing'])
+        self.assertEqual(reader.names, ())
+        self.assertEqual(reader.read(), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
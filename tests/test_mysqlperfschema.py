@@ -0,0 +1,383 @@
+# coding=utf-8
+
+"""
+Tests of the counter store, of the burst sampling, of the queries and of the
+shutdown of MySQLPerfSchemaCollector. Require Diamond (Python 2), MySQLdb is
+replaced by the fake server of the benchmarks.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, os.path.join(ROOT, 'diamond_collectors', 'mysqlsnapshot'))
+sys.path.insert(0, os.path.join(ROOT, 'diamond_collectors', 'mysqlperfschema'))
+
+try:
+    import diamond.collector
+except ImportError:
+    diamond = None
+else:
+    import fakes
+    fakes.install(diamond=False)
+    from mysqlperfschema import BurstSampler, CounterStore, MySQLPerfSchemaCollector, SampleRing, Source
+    from mysqlsnapshot import HostSnapshot
+
+
+@unittest.skipIf(diamond is None, 'Diamond is not installed')
+class CounterStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rates_and_zero_runs(self):
+        store = CounterStore(10)
+        self.assertEqual(store.update('a', 100, 1000.0), (0.0, 1))
+        self.assertEqual(store.update('a', 700, 1060.0), (10.0, 0))
+        self.assertEqual(store.update('a', 700, 1120.0), (0.0, 1))
+        self.assertEqual(store.update('a', 700, 1180.0), (0.0, 2))
+        self.assertEqual(store.delta('b', 5, 1000.0), None)
+        self.assertEqual(store.delta('b', 8, 1060.0), 3.0)
+
+    def test_reset_and_decreasing_values(self):
+        store = CounterStore(10)
+        store.update('a', 100, 1000.0)
+        # the server was restarted: the previous value is ignored
+        self.assertEqual(store.update('a', 400, 1060.0, reset=True), (0.0, 2))
+        self.assertEqual(store.update('a', 1000, 1120.0), (10.0, 0))
+        # the counter was truncated
+        self.assertEqual(store.update('a', 50, 1180.0), (0.0, 1))
+        self.assertEqual(store.update('a', 110, 1240.0), (1.0, 0))
+
+        store.delta('b', 100, 1000.0)
+        self.assertEqual(store.delta('b', 400, 1060.0, reset=True), None)
+        self.assertEqual(store.delta('b', 50, 1120.0), None)
+        self.assertEqual(store.delta('b', 60, 1180.0), 10.0)
+
+    def test_evicts_idle_series(self):
+        store = CounterStore(2)
+        store.update('a', 1, 1000.0)
+        store.update('b', 1, 1000.0)
+        evicted = []
+        for cycle in range(4):
+            evicted.append(store.next_cycle())
+            store.update('a', 1, 1060.0 + cycle)
+        self.assertEqual(evicted, [0, 0, 0, 1])
+        self.assertEqual(sorted(store.slots.keys()), ['a'])
+        # the slot of the evicted series is reused
+        store.update('c', 1, 2000.0)
+        self.assertEqual(len(store.values), 2)
+        # a returning series starts over
+        self.assertEqual(store.update('b', 5, 2000.0), (0.0, 1))
+
+    def test_capacity_evicts_the_least_recently_seen(self):
+        store = CounterStore(0, capacity=2)
+        store.update('a', 1, 1000.0)
+        store.update('b', 1, 1000.0)
+        store.next_cycle()
+        store.update('c', 1, 1060.0)
+        store.update('a', 2, 1060.0)
+        self.assertEqual(store.next_cycle(), 1)
+        self.assertEqual(sorted(store.slots.keys()), ['a', 'c'])
+        self.assertEqual(store.next_cycle(), 0)
+
+    def test_save_and_load_round_trip(self):
+        # the names are the bytes returned by the server, whatever their charset
+        names = ['table.reads.db.plain', 'table.reads.db.caf\xc3\xa9', 'table.reads.db.\xe9\xff']
+        store = CounterStore(10)
+        for i, name in enumerate(names):
+            store.update(name, 1000 * (i + 1), 1000.0 + i)
+        path = os.path.join(self.directory, 'state.json')
+        store.save(path, 2000.0)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        loaded = CounterStore(10)
+        self.assertEqual(loaded.load(path, 2100.0, 3600), 3)
+        self.assertEqual(loaded.saved, 2000.0)
+        self.assertEqual(sorted(loaded.slots.keys()), sorted(names))
+        for i, name in enumerate(names):
+            slot = loaded.slots[name]
+            self.assertEqual((loaded.values[slot], loaded.times[slot]), (1000.0 * (i + 1), 1000.0 + i))
+        # rates resume from the saved values
+        self.assertEqual(loaded.update(names[2], 3600, 1062.0), (10.0, 0))
+
+        # too old
+        self.assertEqual(CounterStore(10).load(path, 6000.0, 3600), 0)
+
+
+# Record the samples, (time, {key: value}), into the ring
+def record(ring, samples):
+    for now, values in samples:
+        ring.next_sample(now)
+        for key, value in values.items():
+            ring.record(key, value)
+
+
+@unittest.skipIf(diamond is None, 'Diamond is not installed')
+class SampleRingTest(unittest.TestCase):
+
+    def test_rates_between_consecutive_samples(self):
+        ring = SampleRing(5, 10)
+        record(ring, [(0.0, {'a': 0}), (10.0, {'a': 100}), (20.0, {'a': 300})])
+        self.assertEqual(ring.drain(), {'a': [10.0, 20.0]})
+        # the last sample is kept as the start of the next interval
+        self.assertEqual(ring.count, 1)
+        record(ring, [(30.0, {'a': 330})])
+        self.assertEqual(ring.drain(), {'a': [3.0]})
+        self.assertEqual(ring.drain(), {})
+
+    def test_ring_wraps_around(self):
+        ring = SampleRing(3, 10)
+        record(ring, [(i * 10.0, {'a': i * i * 10}) for i in range(6)])
+        # only the last 3 samples are left
+        self.assertEqual(ring.drain(), {'a': [7.0, 9.0]})
+
+    def test_values_of_older_samples_are_not_valid(self):
+        ring = SampleRing(3, 10)
+        # b is missing from the second sample, c from all but the first
+        record(ring, [(0.0, {'a': 0, 'b': 0, 'c': 0}), (10.0, {'a': 10}), (20.0, {'a': 20, 'b': 200}),
+                      (30.0, {'a': 30, 'b': 300})])
+        slot = ring.slots['c']
+        # the position of the first sample was overwritten by the fourth, which has no c
+        self.assertEqual(ring.drain(), {'a': [1.0, 1.0], 'b': [10.0]})
+        # c is evicted and its slot reused
+        self.assertEqual(sorted(ring.slots.keys()), ['a', 'b'])
+        self.assertEqual(ring.free, [slot])
+
+    def test_decreasing_counters_give_no_rate(self):
+        ring = SampleRing(5, 10)
+        record(ring, [(0.0, {'a': 100}), (10.0, {'a': 50}), (20.0, {'a': 80})])
+        self.assertEqual(ring.drain(), {'a': [3.0]})
+
+    def test_max_series(self):
+        ring = SampleRing(5, 2)
+        record(ring, [(0.0, {'a': 0, 'b': 0, 'c': 0}), (10.0, {'a': 10, 'b': 10, 'c': 10})])
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(ring.dropped, 2)
+
+
+@unittest.skipIf(diamond is None, 'Diamond is not installed')
+class PublishBurstsTest(unittest.TestCase):
+
+    def collector(self, **config):
+        options = {
+            'hosts': ['stats:secret@db1:3306/None'],
+            'burst_sampling': True,
+            'burst_sources': ['table_io'],
+        }
+        options.update(config)
+        collector = MySQLPerfSchemaCollector(config={'collectors': {'MySQLPerfSchemaCollector': options}})
+        self.published = {}
+        collector.publish = lambda name, value, **kwargs: self.published.__setitem__(name, value)
+        return collector
+
+    # Return a sampler of the host, not started, whose table_io ring holds the
+    # samples of the {key: rates} series, one second apart
+    def sampler(self, collector, series):
+        host, params = collector.host_params[0]
+        sampler = BurstSampler('burst', params, collector.burst_sources, ('', ()), 1, 0.05, 32, 100, 60)
+        ring = sampler.rings['table_io']
+        totals = dict([(key, 0) for key in series])
+        for i in range(len(list(series.values())[0]) + 1):
+            ring.next_sample(float(i))
+            for key, rates in series.items():
+                if i > 0:
+                    totals[key] = totals[key] + rates[i - 1]
+                ring.record(key, totals[key])
+        collector.samplers[host] = sampler
+        return sampler
+
+    def test_nearest_rank_percentiles(self):
+        collector = self.collector()
+        # rates 1 to 20, out of order
+        self.sampler(collector, {('db', 't1'): [(i * 7) % 20 + 1 for i in range(20)]})
+        collector._publish_bursts()
+        self.assertEqual(self.published, {
+            'table.total_peak.db.t1': 20.0,
+            'table.total_p50.db.t1': 10.0,
+            'table.total_p95.db.t1': 19.0,
+            'table.total_p99.db.t1': 20.0,
+        })
+        self.assertEqual(collector.host_stats['stats:secret@db1:3306/None']['metrics'], 4)
+
+    def test_single_rate(self):
+        collector = self.collector()
+        self.sampler(collector, {('db', 't1'): [5]})
+        collector._publish_bursts()
+        for metric in ('peak', 'p50', 'p95', 'p99'):
+            self.assertEqual(self.published['table.total_%s.db.t1' % metric], 5.0)
+
+    def test_burst_top_keeps_the_highest_peaks(self):
+        collector = self.collector(burst_top=1)
+        self.sampler(collector, {('db', 'quiet'): [1, 2, 1], ('db', 'busy'): [1, 50, 1]})
+        collector._publish_bursts()
+        self.assertEqual(sorted(self.published.keys()), ['table.total_p50.db.busy', 'table.total_p95.db.busy',
+                                                          'table.total_p99.db.busy', 'table.total_peak.db.busy'])
+        self.assertEqual(self.published['table.total_p50.db.busy'], 1.0)
+
+
+# schema_include, schema_exclude, min_count_star and top_tables, never found in the SQL
+FILTERS = {
+    'schema_include': ['include_1', "include'; drop table t; --"],
+    'schema_exclude': ['exclude_1'],
+    'min_count_star': 12345,
+    'top_tables': 4321,
+}
+
+WHERE = ("where object_schema <> 'performance_schema' and object_schema in (%s, %s)" +
+         " and object_schema not in (%s) and count_star >= %s")
+
+
+@unittest.skipIf(diamond is None, 'Diamond is not installed')
+class BuildQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = Source('t', 'performance_schema.t', ('object_schema', 'object_name'), (('count_star', 'total'),),
+                             'x.{metric}.{0}.{1}', conditions=("object_schema <> 'performance_schema'",),
+                             schema=True, activity='count_star', top='top_tables')
+
+    def collector(self, **config):
+        options = {'hosts': ['stats:secret@db1:3306/None']}
+        options.update(config)
+        return MySQLPerfSchemaCollector(config={'collectors': {'MySQLPerfSchemaCollector': options}})
+
+    def assertNotInterpolated(self, sql, args):
+        self.assertEqual(sql.count('%s'), len(args))
+        for arg in args:
+            self.assertFalse(str(arg) in sql, arg)
+
+    def test_filters(self):
+        collector = self.collector(**dict(FILTERS, top_tables=0))
+        for window_functions in (False, True):
+            sql, args = collector._build_query(self.source, None, window_functions)
+            self.assertEqual(sql, 'select object_schema as c0, object_name as c1, count_star as c2 ' +
+                             'from performance_schema.t ' + WHERE)
+            self.assertEqual(args, FILTERS['schema_include'] + ['exclude_1', 12345])
+
+        # the schema of the connection string comes first
+        sql, args = collector._build_query(self.source, 'app', False)
+        self.assertTrue(sql.endswith(" where object_schema <> 'performance_schema' and object_schema = %s and " +
+                                     "object_schema in (%s, %s) and object_schema not in (%s) and count_star >= %s"))
+        self.assertEqual(args, ['app'] + FILTERS['schema_include'] + ['exclude_1', 12345])
+        self.assertNotInterpolated(sql, args)
+
+    def test_no_filters(self):
+        sql, args = self.collector()._build_query(self.source, None, True)
+        self.assertEqual(sql, 'select object_schema as c0, object_name as c1, count_star as c2 ' +
+                         "from performance_schema.t where object_schema <> 'performance_schema'")
+        self.assertEqual(args, [])
+
+    def test_top_with_window_functions(self):
+        sql, args = self.collector(**FILTERS)._build_query(self.source, None, True)
+        self.assertEqual(sql, 'select c0, c1, c2 from (select object_schema as c0, object_name as c1, ' +
+                         'count_star as c2, row_number() over (partition by object_schema order by count_star ' +
+                         'desc) as activity_rank from performance_schema.t ' + WHERE +
+                         ') ranked where activity_rank <= %s')
+        self.assertEqual(args, FILTERS['schema_include'] + ['exclude_1', 12345, 4321])
+        self.assertNotInterpolated(sql, args)
+
+    def test_top_with_user_variables(self):
+        sql, args = self.collector(**FILTERS)._build_query(self.source, None, False)
+        self.assertEqual(sql, 'select c0, c1, c2 from (select c0, c1, c2, ' +
+                         '@activity_rank := if(@activity_schema = c0, @activity_rank + 1, 1) as activity_rank, ' +
+                         '@activity_schema := c0 as activity_schema from (select object_schema as c0, ' +
+                         'object_name as c1, count_star as c2 from performance_schema.t ' + WHERE +
+                         ' order by object_schema, count_star desc limit 18446744073709551615) filtered, ' +
+                         '(select @activity_rank := 0, @activity_schema := null) init) ranked ' +
+                         'where activity_rank <= %s')
+        self.assertEqual(args, FILTERS['schema_include'] + ['exclude_1', 12345, 4321])
+        self.assertNotInterpolated(sql, args)
+
+    def test_batched_query_of_all_the_sources(self):
+        sources = ['table_io', 'index_io', 'table_lock', 'file_io', 'wait_events', 'statements']
+        collector = self.collector(sources=sources, top_indexes=17, **FILTERS)
+        host, params = collector.host_params[0]
+        for server_info, window_functions in (('5.7.30-log', False), ('8.0.20', True),
+                                              ('5.5.5-10.3.1-MariaDB', True)):
+            snapshot = HostSnapshot()
+            snapshot.server_info = server_info
+            sql, args = collector._get_query(host, dict(params, db='app'), snapshot)
+            statements = sql.split('; ')
+            self.assertEqual(statements[0], "show global status like 'Uptime'")
+            self.assertEqual(len(statements), len(sources) + 1)
+            self.assertEqual(('row_number()' in sql), window_functions)
+            # the arguments of each source follow those of the previous one
+            expected = []
+            for source in collector.sources:
+                expected.extend(collector._build_query(source, 'app', window_functions)[1])
+            self.assertEqual(args, tuple(expected))
+            self.assertEqual(args[:6], ('app',) + tuple(FILTERS['schema_include']) + ('exclude_1', 12345, 4321))
+            self.assertTrue(17 in args)
+            self.assertNotInterpolated(sql, args)
+
+
+@unittest.skipIf(diamond is None, 'Diamond is not installed')
+class ShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def collector(self, **config):
+        options = {
+            'hosts': ['stats:secret@db1:3306/None'],
+            'counter_state_file': self.path,
+        }
+        options.update(config)
+        return MySQLPerfSchemaCollector(config={'collectors': {'MySQLPerfSchemaCollector': options}})
+
+    def read(self):
+        f = open(self.path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def test_never_saves_a_store_that_did_not_collect(self):
+        store = CounterStore(10)
+        store.update('table.reads.db.t1', 100, 1000.0)
+        store.update('table.reads.db.t2', 200, 1000.0)
+        store.save(self.path, 2000.0)
+        before = self.read()
+
+        # e.g. the copy of the collector in the Diamond server, which never collects
+        collector = self.collector(counter_state_max_age=10 ** 10)
+        self.assertEqual(len(collector.counters), 2)
+        collector.save_counter_state()
+        self.assertEqual(self.read(), before)
+        collector.pid = os.getpid()
+        collector.shutdown()
+        self.assertEqual(self.read(), before)
+
+    def test_saves_from_the_collecting_process_only(self):
+        collector = self.collector()
+        collector.counters.update('table.reads.db.t1', 100, 1000.0)
+        collector.counters.next_cycle()
+
+        # registered by a collection in another process
+        collector.pid = os.getpid() + 1
+        collector.shutdown()
+        self.assertFalse(os.path.exists(self.path))
+
+        collector.pid = os.getpid()
+        collector.shutdown()
+        self.assertEqual([series[0] for series in self.read()['series']], ['table.reads.db.t1'])
+        # once only
+        os.remove(self.path)
+        collector.shutdown()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# coding=utf-8
+
+"""
+Tests of provision_whisper.py against a temporary directory. Require whisper,
+and Diamond (Python 2) for the dry runs of the collectors, which query the fake
+MySQL server of the benchmarks.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import provision_whisper
+
+try:
+    import diamond.collector
+except ImportError:
+    diamond = None
+
+SCHEMAS = """
+[graphite-debug]
+pattern = ^graphite\\.
+retentions = 1s:1d
+
+[mysql_size]
+pattern = ^mysql\\.
+retentions = 10m:1y
+
+[servers]
+pattern = ^servers\\.
+retentions = 1m:43200,5m:95040
+"""
+
+AGGREGATION = """
+[count]
+pattern = \\.count$
+xFilesFactor = 0
+aggregationMethod = sum
+"""
+
+
+def write(path, text):
+    f = open(path, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+
+@unittest.skipIf(provision_whisper.whisper is None, 'whisper is not installed')
+class ProvisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.directory, 'whisper')
+        os.mkdir(self.data_dir)
+        self.schemas = os.path.join(self.directory, 'storage-schemas.conf')
+        self.aggregation = os.path.join(self.directory, 'storage-aggregation.conf')
+        write(self.schemas, SCHEMAS)
+        write(self.aggregation, AGGREGATION)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def options(self, *args):
+        return provision_whisper.parse_options(['--metrics', '-', '--data-dir', self.data_dir,
+                                                '--schemas', self.schemas, '--aggregation', self.aggregation] +
+                                               list(args))
+
+    def provision(self, metrics, *args):
+        options = self.options(*args)
+        provisioner = provision_whisper.Provisioner(
+            options, provision_whisper.Storage(options.schemas, options.aggregation))
+        provisioner.create(provisioner.plan(metrics))
+        if options.prune_prefix:
+            provisioner.prune(metrics, options.prune_prefix)
+        return provisioner.counts
+
+    def path(self, metric):
+        return provision_whisper.metric_file(self.data_dir, metric)
+
+    # Create a file as carbon would have, last updated age seconds ago
+    def old_file(self, metric, age):
+        path = self.path(metric)
+        os.makedirs(os.path.dirname(path))
+        write(path, '')
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_read_metrics(self):
+        metrics = provision_whisper.read_metrics(['mysql.db1.a 1 1500000000\n', '# comment\n', '\n', 'mysql.db1.b\n'])
+        self.assertEqual(metrics, set(['mysql.db1.a', 'mysql.db1.b']))
+
+    def test_storage_first_matching_schema(self):
+        storage = provision_whisper.Storage(self.schemas, self.aggregation)
+        self.assertEqual(storage.lookup('mysql.db1.size.s.t.data_length'), ([(600, 52560)], None, None))
+        self.assertEqual(storage.lookup('servers.h.cpu.count'), ([(60, 43200), (300, 95040)], 0.0, 'sum'))
+        self.assertEqual(storage.lookup('other.metric'), None)
+
+    def test_creates_the_missing_files(self):
+        existing = self.old_file('mysql.db1.size.s.t1.table_rows', 0)
+        counts = self.provision(['mysql.db1.size.s.t1.table_rows', 'mysql.db1.size.s.t1.data_length',
+                                 'servers.h.cpu.count', 'other.metric'])
+        self.assertEqual((counts['existing'], counts['created'], counts['unmatched'], counts['failed']),
+                         (1, 2, 1, 0))
+        self.assertEqual(os.path.getsize(existing), 0)
+
+        info = provision_whisper.whisper.info(self.path('mysql.db1.size.s.t1.data_length'))
+        self.assertEqual([(archive['secondsPerPoint'], archive['points']) for archive in info['archives']],
+                         [(600, 52560)])
+        info = provision_whisper.whisper.info(self.path('servers.h.cpu.count'))
+        self.assertEqual(info['aggregationMethod'], 'sum')
+        self.assertEqual(info['xFilesFactor'], 0.0)
+        self.assertFalse(os.path.exists(self.path('other.metric')))
+
+        # nothing left to do
+        counts = self.provision(['mysql.db1.size.s.t1.data_length', 'servers.h.cpu.count'])
+        self.assertEqual((counts['existing'], counts['created']), (2, 0))
+
+    def test_rate_limit(self):
+        metrics = ['mysql.db1.size.s.t%d.data_length' % i for i in range(7)]
+        start = time.time()
+        counts = self.provision(metrics, '--rate', '600', '--workers', '3')
+        # 6 intervals of 0.1s between the 7 creations
+        self.assertTrue(time.time() - start >= 0.55)
+        self.assertEqual(counts['created'], 7)
+
+    def test_prune(self):
+        dropped = self.old_file('mysql.db1.size.s.dropped.data_length', 7 * 86400)
+        recent = self.old_file('mysql.db1.size.s.recent.data_length', 60)
+        outside = self.old_file('mysql.db2.size.s.dropped.data_length', 7 * 86400)
+        kept = self.old_file('mysql.db1.size.s.kept.data_length', 7 * 86400)
+
+        counts = self.provision(['mysql.db1.size.s.kept.data_length'], '--prune-prefix', 'mysql.db1', '--dry-run')
+        self.assertEqual(counts['pruned'], 1)
+        self.assertTrue(os.path.exists(dropped))
+
+        counts = self.provision(['mysql.db1.size.s.kept.data_length'], '--prune-prefix', 'mysql.db1')
+        self.assertEqual(counts['pruned'], 1)
+        self.assertFalse(os.path.exists(dropped))
+        # the empty directory of the dropped table is removed too
+        self.assertFalse(os.path.exists(os.path.dirname(dropped)))
+        for path in (recent, outside, kept):
+            self.assertTrue(os.path.exists(path))
+
+    def test_dry_run_creates_nothing(self):
+        counts = self.provision(['mysql.db1.size.s.t1.data_length'], '--dry-run')
+        self.assertEqual(counts['created'], 0)
+        self.assertEqual(os.listdir(self.data_dir), [])
+
+    def test_main(self):
+        metrics = os.path.join(self.directory, 'metrics.txt')
+        write(metrics, 'mysql.db1.size.s.t1.data_length 1 1500000000\nservers.h.cpu.idle 2 1500000000\n')
+        status = provision_whisper.main(['--metrics', metrics, '--data-dir', self.data_dir,
+                                         '--schemas', self.schemas, '--aggregation', self.aggregation])
+        self.assertEqual(status, 0)
+        self.assertTrue(os.path.exists(self.path('mysql.db1.size.s.t1.data_length')))
+        self.assertTrue(os.path.exists(self.path('servers.h.cpu.idle')))
+
+
+@unittest.skipIf(provision_whisper.whisper is None or diamond is None, 'whisper or Diamond is not installed')
+class DryRunTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+        import fakes
+        fakes.install(diamond=False)
+        fakes.DEFAULT[0] = fakes.Backend(fakes.Scale(schemas=2, tables=3, indexes=2))
+        self.directory = tempfile.mkdtemp()
+        self.collectors_path = [os.path.join(ROOT, 'diamond_collectors')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def config(self, text):
+        path = os.path.join(self.directory, 'collector.conf')
+        write(path, text)
+        return path
+
+    def test_size_collector_configuration_file(self):
+        config = self.config('host = db1\nuser = stats\npassword = stats\npath_prefix = mysql\n' +
+                             'metrics_blacklist = ^collector\\.\n')
+        paths = provision_whisper.dry_run('mysqldbsizes.MySQLSizeCollector', self.collectors_path, config,
+                                          'db1', 1, 0)
+        self.assertTrue('mysql.db1.mysql.size.schema_0.table_2.data_length' in paths)
+        for path in paths:
+            self.assertTrue(path.startswith('mysql.db1.mysql.'), path)
+            # blacklisted
+            self.assertFalse(path.startswith('mysql.db1.mysql.collector.'), path)
+
+    def test_perfschema_collector_diamond_conf(self):
+        config = self.config('[collectors]\n[[default]]\npath_prefix = mysql\n' +
+                             '[[MySQLPerfSchemaCollector]]\nhosts = stats:stats@db1:3306/None\n')
+        paths = provision_whisper.dry_run('mysqlperfschema.MySQLPerfSchemaCollector', self.collectors_path,
+                                          config, 'db1', 2, 0)
+        # the rates of the tables and the indexes are published from the second cycle
+        tables = [path for path in paths if path.startswith('mysql.db1.MySQLPerfSchemaCollector.table.')]
+        indexes = [path for path in paths if path.startswith('mysql.db1.MySQLPerfSchemaCollector.index.')]
+        self.assertTrue(tables)
+        self.assertTrue(indexes)
+        for path in paths:
+            self.assertTrue(path.startswith('mysql.db1.MySQLPerfSchemaCollector.'), path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+# coding=utf-8
+
+"""
+Tests of the SpoolGraphiteHandler against a local TCP listener standing in for
+carbon. Requires Diamond (Python 2).
+"""
+
+import os
+import pickle
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'diamond_handlers', 'spoolgraphite'))
+
+try:
+    from diamond.handler.Handler import Handler
+    from diamond.metric import Metric
+except ImportError:
+    Handler = None
+else:
+    import spoolgraphite
+    from spoolgraphite import Spool, SpoolGraphiteHandler
+
+
+# Return a port nobody listens on
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# Accepts connections on a port and keeps everything it receives
+class Listener(object):
+
+    def __init__(self, port=0):
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.data = b''
+        self.connections = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self.socket.accept()
+            except socket.error:
+                return
+            self.connections.append(conn)
+            thread = threading.Thread(target=self._read, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, conn):
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            with self.lock:
+                self.data = self.data + data
+
+    def lines(self):
+        with self.lock:
+            return self.data.splitlines()
+
+    def pickled(self):
+        with self.lock:
+            data = self.data
+        points = []
+        while len(data) >= 4:
+            length = struct.unpack('!L', data[:4])[0]
+            points.extend(pickle.loads(data[4:4 + length]))
+            data = data[4 + length:]
+        return points
+
+    # Wait until count() returns at least expected
+    def wait(self, count, expected, timeout=5):
+        end = time.time() + timeout
+        while count() < expected and time.time() < end:
+            time.sleep(0.01)
+        return count()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+
+def metric(i):
+    return Metric('servers.host.metric%d' % (i % 10), i, timestamp=1500000000 + i)
+
+
+# Stands in for the time module of the handler, advanced by the tests
+class Clock(object):
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+@unittest.skipIf(Handler is None, 'Diamond is not installed')
+class SpoolGraphiteHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.listeners = []
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.spool.close()
+            handler._close()
+        for listener in self.listeners:
+            listener.close()
+        shutil.rmtree(self.directory)
+
+    def listener(self, port=0):
+        listener = Listener(port)
+        self.listeners.append(listener)
+        return listener
+
+    def handler(self, port, **config):
+        options = {
+            'host': '127.0.0.1',
+            'port': port,
+            'batch': 10,
+            'reconnect_interval': 0,
+            'replay_rate': 1000000,
+            'spool_path': os.path.join(self.directory, 'graphite.spool'),
+            'spool_size_mb': 1,
+        }
+        options.update(config)
+        handler = SpoolGraphiteHandler(options)
+        self.handlers.append(handler)
+        return handler
+
+    def test_is_a_diamond_handler(self):
+        self.assertTrue(issubclass(SpoolGraphiteHandler, Handler))
+
+    def test_sends_plaintext(self):
+        listener = self.listener()
+        handler = self.handler(listener.port)
+        for i in range(25):
+            handler.process(metric(i))
+        handler.flush()
+        self.assertEqual(listener.wait(lambda: len(listener.lines()), 25), 25)
+        self.assertEqual(listener.lines()[3], b'servers.host.metric3 3 1500000003')
+        self.assertEqual(handler.spool.records, 0)
+
+    def test_sends_pickle(self):
+        listener = self.listener()
+        handler = self.handler(listener.port, protocol='pickle')
+        for i in range(25):
+            handler.process(metric(i))
+        handler.flush()
+        self.assertEqual(listener.wait(lambda: len(listener.pickled()), 25), 25)
+        self.assertEqual(listener.pickled()[3], ('servers.host.metric3', (1500000003, 3.0)))
+
+    def test_spools_and_replays(self):
+        port = free_port()
+        handler = self.handler(port)
+        for i in range(50):
+            handler.process(metric(i))
+        handler.flush()
+        self.assertEqual(handler.spool.records, 5)
+
+        # carbon comes back: the live batch and then the backlog are sent
+        listener = self.listener(port)
+        for i in range(50, 60):
+            handler.process(metric(i))
+        for i in range(10):
+            handler.flush()
+            if handler.spool.records == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(handler.spool.records, 0)
+        self.assertEqual(listener.wait(lambda: len(listener.lines()), 60), 60)
+        values = sorted([int(line.split()[1]) for line in listener.lines()])
+        self.assertEqual(values, list(range(60)))
+
+    def test_spool_survives_a_restart(self):
+        port = free_port()
+        handler = self.handler(port)
+        for i in range(30):
+            handler.process(metric(i))
+        handler.flush()
+        handler.spool.close()
+        self.handlers.remove(handler)
+
+        listener = self.listener(port)
+        handler = self.handler(port)
+        self.assertEqual(handler.spool.records, 3)
+        for i in range(10):
+            handler.flush()
+            time.sleep(0.01)
+        self.assertEqual(listener.wait(lambda: len(listener.lines()), 30), 30)
+
+    def test_replay_rate_with_sparse_flushes(self):
+        clock = Clock()
+        spoolgraphite.time = clock
+        self.addCleanup(setattr, spoolgraphite, 'time', time)
+
+        port = free_port()
+        handler = self.handler(port, replay_rate=10, replay_burst=60)
+        for i in range(1000):
+            handler.process(metric(i))
+        handler.flush()
+        self.assertEqual(handler.spool.records, 100)
+
+        # Diamond flushes once per collector run: 30 seconds of budget are 30 batches
+        listener = self.listener(port)
+        clock.now = clock.now + 30
+        handler.flush()
+        self.assertEqual(handler.spool.records, 70)
+        self.assertEqual(listener.wait(lambda: len(listener.lines()), 300), 300)
+
+        # the budget accrues up to replay_burst seconds
+        clock.now = clock.now + 3600
+        handler.flush()
+        self.assertEqual(handler.spool.records, 10)
+        self.assertEqual(listener.wait(lambda: len(listener.lines()), 900), 900)
+
+    def test_evicts_the_oldest_batches(self):
+        # room for a few batches of 10 points only
+        handler = self.handler(free_port(), spool_size_mb=1024 / (1024.0 * 1024))
+        for i in range(200):
+            handler.process(metric(i))
+        self.assertTrue(0 < handler.spool.used() <= 1024)
+        self.assertTrue(handler.spool.evicted > 0)
+        # the newest batch is kept
+        self.assertTrue(handler.spool.records < 20)
+        last = b''
+        while handler.spool.records:
+            last = handler.spool.peek()
+            handler.spool.pop()
+        self.assertTrue(last.startswith(b'servers.host.metric0 190 '))
+
+
+@unittest.skipIf(Handler is None, 'Diamond is not installed')
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ring.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_wrap_around_the_ring(self):
+        spool = Spool(self.path, 1000)
+        records = [(b'%03d' % i) * (i % 37 + 1) for i in range(200)]
+        read = []
+        for record in records:
+            spool.append(record)
+            if spool.records > 3:
+                read.append(spool.peek())
+                spool.pop()
+        while spool.records:
+            read.append(spool.peek())
+            spool.pop()
+        spool.close()
+        self.assertEqual(read, records)
+
+    def test_record_larger_than_the_spool(self):
+        spool = Spool(self.path, 100)
+        self.assertEqual(spool.append(b'x' * 200), -1)
+        self.assertEqual(spool.records, 0)
+        spool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()